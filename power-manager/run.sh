@@ -14,21 +14,77 @@ SAX_HOST=$(bashio::config 'sax_host')
 SAX_PORT=$(bashio::config 'sax_port')
 ADL_HOST=$(bashio::config 'adl_host')
 ADL_PORT=$(bashio::config 'adl_port')
+TELEMETRY_EVERY=$(bashio::config 'telemetry_every')
+TELEMETRY_WINDOW=$(bashio::config 'telemetry_window')
+TELEMETRY_PRECISION=$(bashio::config 'telemetry_precision')
 CONFIG_LOGLEVEL=$(bashio::config 'loglevel')
 TIMEOUT=$(bashio::config 'timeout')
+STALE_AFTER=$(bashio::config 'stale_after')
+STALE_POLICY=$(bashio::config 'stale_policy')
+MIN_INTERVAL=$(bashio::config 'min_interval')
+MAX_INTERVAL=$(bashio::config 'max_interval')
+VOLATILITY_THRESHOLD=$(bashio::config 'volatility_threshold')
+OVERRUN_POLICY=$(bashio::config 'overrun_policy')
+CONTROLLER=$(bashio::config 'controller')
+CONTROLLER_KP=$(bashio::config 'controller_kp')
+CONTROLLER_KI=$(bashio::config 'controller_ki')
+CONTROLLER_KD=$(bashio::config 'controller_kd')
+SLEW_RATE=$(bashio::config 'slew_rate')
+PV_FEED_FORWARD=$(bashio::config 'pv_feed_forward')
+SETPOINT_TOLERANCE=$(bashio::config 'setpoint_tolerance')
+SETPOINT_KEEPALIVE=$(bashio::config 'setpoint_keepalive')
+LIMITS_KEEPALIVE=$(bashio::config 'limits_keepalive')
 MQTT_UPDATE_FACTOR=$(bashio::config 'mqtt_update_factor')
+MQTT_MAX_AGE=$(bashio::config 'mqtt_max_age')
+MQTT_DEADBAND_FACTOR=$(bashio::config 'mqtt_deadband_factor')
+HISTORY_HOURS=$(bashio::config 'history_hours')
+LOG_SUMMARY_INTERVAL=$(bashio::config 'log_summary_interval')
+TRACE_CYCLES=$(bashio::config 'trace_cycles')
 
 PV_URL="$(bashio::config 'pv_url')"
 PV_USERNAME="$(bashio::config 'pv_user')"
 PV_PASSWORD="$(bashio::config 'pv_password')"
+PV_INTERVAL=$(bashio::config 'pv_interval')
+PV_TIMEOUT=$(bashio::config 'pv_timeout')
 
 cd /srv
 if [ -f "./venv/bin/activate" ] ; then
     source ./venv/bin/activate
 fi
 
+ARGS=("--timeout=$TIMEOUT" "--stale-after=$STALE_AFTER" "--stale-policy=$STALE_POLICY" "--min-interval=$MIN_INTERVAL" "--max-interval=$MAX_INTERVAL" "--volatility-threshold=$VOLATILITY_THRESHOLD" "--overrun-policy=$OVERRUN_POLICY" "--controller=$CONTROLLER" "--kp=$CONTROLLER_KP" "--ki=$CONTROLLER_KI" "--kd=$CONTROLLER_KD" "--slew-rate=$SLEW_RATE" "--pv-feed-forward=$PV_FEED_FORWARD" "--setpoint-tolerance=$SETPOINT_TOLERANCE" "--setpoint-keepalive=$SETPOINT_KEEPALIVE" "--limits-keepalive=$LIMITS_KEEPALIVE" "--mqtt-update-factor=$MQTT_UPDATE_FACTOR" "--mqtt-max-age=$MQTT_MAX_AGE" "--mqtt-deadband-factor=$MQTT_DEADBAND_FACTOR" "--host-sax=$SAX_HOST" "--port-sax=$SAX_PORT" "--host-adl=$ADL_HOST" "--port-adl=$ADL_PORT" "--telemetry-every=$TELEMETRY_EVERY" "--telemetry-window=$TELEMETRY_WINDOW" "--telemetry-precision=$TELEMETRY_PRECISION" "--host-mqtt=$MQTT_HOST" "--port-mqtt=$MQTT_PORT" "--user-mqtt=$MQTT_USER" "--pw-mqtt=$MQTT_PASSWORD" "--log=$CONFIG_LOGLEVEL" "--log-summary-interval=$LOG_SUMMARY_INTERVAL" "--trace-cycles=$TRACE_CYCLES" "--url-pv=$PV_URL" "--user-pv=$PV_USERNAME" "--pw-pv=$PV_PASSWORD" "--pv-interval=$PV_INTERVAL" "--pv-timeout=$PV_TIMEOUT" "--history-hours=$HISTORY_HOURS")
+
+for battery in $(bashio::config 'additional_batteries|keys'); do
+  BATTERY="$(bashio::config "additional_batteries[${battery}].host"):$(bashio::config "additional_batteries[${battery}].port")"
+  if bashio::config.has_value "additional_batteries[${battery}].unit_id"; then
+    BATTERY="$BATTERY:$(bashio::config "additional_batteries[${battery}].unit_id")"
+  fi
+  ARGS+=("--battery=$BATTERY")
+done
+for inverter in $(bashio::config 'additional_inverters|keys'); do
+  INVERTER=("--inverter" "$(bashio::config "additional_inverters[${inverter}].url")")
+  if bashio::config.has_value "additional_inverters[${inverter}].user"; then
+    INVERTER+=("$(bashio::config "additional_inverters[${inverter}].user")" "$(bashio::config "additional_inverters[${inverter}].password")")
+  fi
+  ARGS+=("${INVERTER[@]}")
+done
 if bashio::config.true 'simulate_write'; then
-  python pwrmgr.py "-sim" "--timeout=$TIMEOUT" "--mqtt-update-factor=$MQTT_UPDATE_FACTOR" "--host-sax=$SAX_HOST" "--port-sax=$SAX_PORT" "--host-adl=$ADL_HOST" "--port-adl=$ADL_PORT" "--host-mqtt=$MQTT_HOST" "--port-mqtt=$MQTT_PORT" "--user-mqtt=$MQTT_USER" "--pw-mqtt=$MQTT_PASSWORD" "--log=$CONFIG_LOGLEVEL" "--url-pv=$PV_URL" "--user-pv=$PV_USERNAME" "--pw-pv=$PV_PASSWORD"
-else
-  python pwrmgr.py "--timeout=$TIMEOUT" "--mqtt-update-factor=$MQTT_UPDATE_FACTOR" "--host-sax=$SAX_HOST" "--port-sax=$SAX_PORT" "--host-adl=$ADL_HOST" "--port-adl=$ADL_PORT" "--host-mqtt=$MQTT_HOST" "--port-mqtt=$MQTT_PORT" "--user-mqtt=$MQTT_USER" "--pw-mqtt=$MQTT_PASSWORD" "--log=$CONFIG_LOGLEVEL"  "--url-pv=$PV_URL" "--user-pv=$PV_USERNAME" "--pw-pv=$PV_PASSWORD"
+  ARGS+=("-sim")
+fi
+if bashio::config.true 'adaptive_cadence'; then
+  ARGS+=("--adaptive")
+fi
+if bashio::config.true 'adl_reactive_power'; then
+  ARGS+=("--adl-reactive-power")
+fi
+if bashio::config.true 'telemetry_min_max'; then
+  ARGS+=("--telemetry-min-max")
 fi
+if bashio::config.true 'mqtt_json_state'; then
+  ARGS+=("--mqtt-json-state")
+fi
+if bashio::config.true 'metrics_endpoint'; then
+  ARGS+=("--metrics-port=9102")
+fi
+
+python pwrmgr.py "${ARGS[@]}"
@@ -0,0 +1,33 @@
+class WindowAggregator:
+    # Running count, sum, min and max per signal over windows of window seconds. Values are added when
+    # they were read, collect() returns (mean, min, max) per signal at the end of a window and starts
+    # the next one. The telemetry is read at a fixed cycle cadence, so the mean is not time-weighted.
+
+    def __init__(self, window):
+        self.window = window
+        self.start = None
+        self._stats = {}                  # signal => [count, sum, min, max]
+
+    def add(self, signal, value, now):
+        if self.start is None:
+            # The first window ends with the first reading, the values are known from the start on
+            self.start = now - self.window
+        stats = self._stats.get(signal)
+        if stats is None:
+            self._stats[signal] = [1, value, value, value]
+            return
+        stats[0] += 1
+        stats[1] += value
+        if value < stats[2]:
+            stats[2] = value
+        elif value > stats[3]:
+            stats[3] = value
+
+    def due(self, now):
+        return self.start is not None and now - self.start >= self.window
+
+    def collect(self, now):
+        result = {signal: (total / count, lowest, highest) for signal, (count, total, lowest, highest) in self._stats.items()}
+        self._stats = {}
+        self.start = now
+        return result
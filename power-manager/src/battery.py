@@ -0,0 +1,92 @@
+import math
+import struct
+
+from modbus import AsyncModbusClient, CircuitBreaker
+
+SAX_OFFSET = 16384
+SAX_REGISTERS = struct.Struct(">4H")   # Registers 45-48: mode, SoC, power, smart meter power
+BATTERY_MAX_CHARGING = 3500        # W per unit, bounds the prioritized charging from grid
+BATTERY_MAX_DISCHARGING = 4600     # W per unit
+
+class Battery:
+    # One SAX Battery unit with its Modbus client and the registers 45-48 of the last cycle, value
+    # holds them as received, registers decoded.
+    # The first unit keeps the topics of single battery installations (battery/..), further units
+    # are numbered from 2 (battery2/..).
+    def __init__(self, number, host, port, unit_id):
+        self.number = number
+        self.name = "SAX Battery" if number == 1 else f"SAX Battery {number}"
+        self.suffix = "" if number == 1 else str(number)
+        self.source = f"sax{self.suffix}"
+        self.client = AsyncModbusClient(host=host, port=port, unit_id=unit_id, breaker=CircuitBreaker(self.name))
+        self.value = None
+        self.registers = None
+
+    def update(self, value):
+        self.value = value
+        self.registers = SAX_REGISTERS.unpack(value)
+
+    @property
+    def mode(self):
+        return self.registers[0]
+
+    @property
+    def soc(self):
+        return self.registers[1]
+
+    @property
+    def power(self):
+        return self.registers[2] - SAX_OFFSET
+
+    @property
+    def smpower(self):
+        return self.registers[3] - SAX_OFFSET
+
+    def bounds(self, lower, upper, reserve):
+        # Target power range of the unit within the given limits and its SoC
+        if self.soc >= 100:
+            lower = max(lower, 0)       # Battery full, no charging
+        if self.soc <= reserve:
+            upper = min(upper, 0)       # Reserve reached, no discharging
+        return lower, upper
+
+def parse_battery(spec):
+    # host:port[:unit id] of an additional battery
+    parts = spec.split(":")
+    if len(parts) not in (2, 3):
+        raise ValueError(f"Battery {spec} is not given as host:port[:unit id]")
+    return parts[0], int(parts[1]), int(parts[2]) if len(parts) == 3 else None
+
+def dispatch(target, bounds, socs, reserve):
+    # Splits the combined target power (positive = discharging) into one integer target per unit.
+    # The shares are weighted by the headroom of each unit in the requested direction and by its SoC
+    # (more charged units discharge more, less charged units charge more). Units reaching their
+    # bound are saturated and the rest is redistributed to the others.
+    if target >= 0:
+        caps = [max(upper, 0) for lower, upper in bounds]
+        factors = [max(soc - reserve, 0) + 1 for soc in socs]
+    else:
+        caps = [max(-lower, 0) for lower, upper in bounds]
+        factors = [max(100 - soc, 0) + 1 for soc in socs]
+    remaining = min(abs(target), sum(caps))
+    shares = [0.0] * len(bounds)
+    active = [unit for unit, cap in enumerate(caps) if cap > 0]
+    while active and remaining > 0:
+        weight = sum(caps[unit] * factors[unit] for unit in active)
+        saturated = [unit for unit in active if remaining * factors[unit] >= weight]
+        if not saturated:
+            for unit in active:
+                shares[unit] = remaining * caps[unit] * factors[unit] / weight
+            break
+        for unit in saturated:
+            shares[unit] = caps[unit]
+            remaining -= caps[unit]
+            active.remove(unit)
+
+    # Largest remainder rounding keeps the sum of the unit targets equal to the rounded total
+    result = [math.floor(share) for share in shares]
+    missing = int(round(sum(shares))) - sum(result)
+    for unit in sorted(range(len(shares)), key=lambda unit: result[unit] - shares[unit])[:missing]:
+        result[unit] += 1
+    sign = 1 if target >= 0 else -1
+    return [sign * value for value in result]
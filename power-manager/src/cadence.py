@@ -0,0 +1,27 @@
+class AdaptiveCadence:
+    # Chooses the period of the control cycle between min_interval and max_interval.
+    # Activity is a change of the grid power or of the control error (target power not yet followed
+    # by the batteries) by more than threshold W since the last cycle, or a remaining control error
+    # above threshold. Grid changes are ignored while the batteries are saturated, they cannot react.
+    # Activity switches to min_interval at once, calm cycles lengthen the period by growth per cycle.
+
+    def __init__(self, min_interval, max_interval, threshold=200, growth=1.25):
+        self.min_interval = min_interval
+        self.max_interval = max(max_interval, min_interval)
+        self.threshold = threshold
+        self.growth = growth
+        self.interval = min_interval
+        self.last = None
+
+    def update(self, grid_power, error, saturated=False):
+        if self.last is not None:
+            last_grid, last_error = self.last
+            change = abs(error - last_error)
+            if not saturated:
+                change = max(change, abs(grid_power - last_grid))
+            if change > self.threshold or abs(error) > self.threshold:
+                self.interval = self.min_interval
+            else:
+                self.interval = min(self.interval * self.growth, self.max_interval)
+        self.last = (grid_power, error)
+        return self.interval
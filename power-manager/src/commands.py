@@ -0,0 +1,34 @@
+COMMAND_POWER = "power"
+COMMAND_GRID_LOADING = "grid_loading"
+COMMAND_EMERGENCY_RESERVE = "emergency_reserve"
+COMMAND_LIMIT_CHARGING = "limit_charging"
+COMMAND_LIMIT_DISCHARGING = "limit_discharging"
+COMMAND_PRIO_CHARGING = "prio_charging"
+
+# Command topics relative to the power manager base topic
+COMMAND_TOPICS = {
+    "battery/power-cmd": COMMAND_POWER,
+    "battery/grid-loading": COMMAND_GRID_LOADING,
+    "battery/emergency-power-reserve": COMMAND_EMERGENCY_RESERVE,
+    "battery/charging-limit": COMMAND_LIMIT_CHARGING,
+    "battery/discharging-limit": COMMAND_LIMIT_DISCHARGING,
+    "battery/prio-charging": COMMAND_PRIO_CHARGING,
+}
+
+class CommandQueue:
+    # Latest received payload per command, filled by the MQTT message loop without any device I/O
+    # and applied by the control loop between two cycles. A burst of messages (e.g. dragging a
+    # slider in HA) only applies its last value.
+
+    def __init__(self):
+        self.pending = {}
+        self.coalesced = 0
+
+    def put(self, command, payload):
+        if command in self.pending:
+            self.coalesced += 1
+        self.pending[command] = payload
+
+    def take(self):
+        pending, self.pending = self.pending, {}
+        return pending
@@ -0,0 +1,80 @@
+import time
+
+MODE_P = "P"
+MODE_PI = "PI"
+MODE_PID = "PID"
+CONTROLLER_MODES = (MODE_P, MODE_PI, MODE_PID)
+
+def clamp(value, lower, upper):
+    return min(max(value, lower), upper)
+
+class PowerController:
+    # Computes the battery target power from the measured battery power and the grid power
+    # (positive = import, the error to be controlled to zero).
+    # Mode P: target = battery power + kp * grid power, with kp=1 this is the one-shot target of
+    # former versions. Modes PI/PID: target = kp * e + integral (+ kd * de/dt), the integral starts
+    # from the measured battery power and tracks the limited output while saturated (anti-windup).
+    # The output can be limited by a slew rate (W/s) and corrected by a feed-forward of PV changes.
+
+    def __init__(self, mode=MODE_P, kp=1.0, ki=0.0, kd=0.0, slew_rate=0, pv_feed_forward=0.0):
+        self.mode = mode
+        self.kp = kp
+        self.ki = ki
+        self.kd = kd if mode == MODE_PID else 0.0
+        self.slew_rate = slew_rate
+        self.pv_feed_forward = pv_feed_forward
+        self.reset()
+
+    def reset(self):
+        self.integral = None
+        self.last_error = None
+        self.last_output = None
+        self.last_pv = None
+        self.last_time = None
+
+    def update(self, battery_power, grid_power, lower, upper, pv_power=None, now=None):
+        now = time.monotonic() if now is None else now
+        dt = 0.0 if self.last_time is None else now - self.last_time
+        self.last_time = now
+        error = grid_power
+
+        feed_forward = 0.0
+        if self.pv_feed_forward and pv_power is not None and self.last_pv is not None:
+            # More PV reduces the grid import before the meter sees it, so charge more / discharge less.
+            # Only the change of one cycle is added to the output, the meter reading covers it afterwards.
+            feed_forward = -self.pv_feed_forward * (pv_power - self.last_pv)
+        self.last_pv = pv_power
+
+        if self.mode == MODE_P:
+            output = battery_power + self.kp * error + feed_forward
+        else:
+            if self.integral is None:
+                # Bumpless start from the current battery power
+                self.integral = battery_power - self.kp * error
+            elif dt > 0:
+                self.integral += self.ki * error * dt
+            derivative = 0.0
+            if self.kd and dt > 0 and self.last_error is not None:
+                derivative = self.kd * (error - self.last_error) / dt
+            output = self.kp * error + self.integral + derivative + feed_forward
+        self.last_error = error
+
+        limited = output
+        if self.slew_rate > 0 and self.last_output is not None and dt > 0:
+            step = self.slew_rate * dt
+            limited = clamp(limited, self.last_output - step, self.last_output + step)
+        limited = clamp(limited, lower, upper)
+
+        if self.integral is not None and limited != output:
+            # Anti-windup: the integral follows the limited output instead of growing further
+            self.integral += limited - output
+
+        self.last_output = limited
+        return int(round(limited))
+
+    def hold(self, value):
+        # Output is overridden (e.g. grid loading), continue from the overriding value without history
+        self.integral = None
+        self.last_error = None
+        self.last_pv = None
+        self.last_output = value
@@ -0,0 +1,61 @@
+import asyncio
+from collections import namedtuple
+
+# User settings of the control law, changed by MQTT commands. A change creates a new instance,
+# a cycle works on the instance taken at its start.
+Settings = namedtuple("Settings", [
+    "grid_loading", "emergency_reserve", "limit_charging", "limit_discharging", "prio_charging"
+], defaults=(False, 9, 3500, 3500, 3500))
+
+class CycleSnapshot(namedtuple("CycleSnapshot", [
+    "number", "time", "timestamp", "settings",
+    "batteries", "adl", "fresh", "pv", "pv_stale",
+    "grid_power", "powers", "socs", "batteries_power",
+    "target", "unit_targets", "calc",
+])):
+    # Immutable result of one complete control cycle: raw register blocks and decoded readings of all
+    # devices, the settings used and the computed setpoints. time is the monotonic time of the readings,
+    # timestamp the wall clock time. Register blocks are the bytes of the Modbus responses, two big-endian
+    # bytes per register. batteries holds the registers 45-48 of each unit, None for a unit
+    # without readings in this cycle (as in powers and socs). fresh holds the ADL400 offsets read in this
+    # cycle, calc the values computed by the cycle as read-only mapping.
+    # Snapshots are shared by reference between the stages, none of them copies or changes one.
+    __slots__ = ()
+
+    def blocks(self, sources):
+        # Data blocks by entity source, sources are the battery sources (sax, sax2, ..) in unit order
+        blocks = {"adl": self.adl, "pv": self.pv, "calc": self.calc}
+        blocks.update(zip(sources, self.batteries))
+        return blocks
+
+class Subscription:
+    # Waits for the next snapshot of the bus. A subscriber slower than the cycle gets the newest
+    # snapshot and skips the ones in between instead of building a queue.
+    def __init__(self, bus):
+        self.bus = bus
+        self.event = asyncio.Event()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        await self.event.wait()
+        self.event.clear()
+        return self.bus.latest
+
+class SnapshotBus:
+    # Hands the snapshot of each cycle to the subscribed stages (MQTT publisher, recorder, ..).
+    # Publishing replaces the reference to the latest snapshot, readers always see a complete one.
+    def __init__(self):
+        self.latest = None
+        self._subscriptions = []
+
+    def subscribe(self):
+        subscription = Subscription(self)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def publish(self, snapshot):
+        self.latest = snapshot
+        for subscription in self._subscriptions:
+            subscription.event.set()
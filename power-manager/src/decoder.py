@@ -0,0 +1,89 @@
+import struct
+
+from entities import decode, scale_digits
+
+# Struct codes of a value by width in registers and signedness, registers are big-endian with the high word first
+FIELD_CODES = {(1, False): "H", (1, True): "h", (2, False): "I", (2, True): "i"}
+
+class BlockDecoder:
+    # Decoder of the entities of one Modbus register block, compiled once from their index, width,
+    # signedness, scale and offset. All values are unpacked from the register bytes of the response by
+    # one struct per layout, overlapping values (e.g. the same register signed and unsigned) get a
+    # further layout.
+    # entities holds the entities in the order of the decoded values.
+
+    def __init__(self, entities):
+        fields = sorted(entities, key=lambda entity: entity.index)
+        self.layouts = []
+        ordered = []
+        while fields:
+            codes, rest, end = [">"], [], 0
+            for entity in fields:
+                if entity.index < end:
+                    rest.append(entity)
+                    continue
+                if entity.index > end:
+                    codes.append(f"{2 * (entity.index - end)}x")
+                codes.append(FIELD_CODES[(entity.width, entity.signed)])
+                ordered.append(entity)
+                end = entity.index + entity.width
+            self.layouts.append(struct.Struct("".join(codes)))
+            fields = rest
+        self.entities = tuple(ordered)
+        # Only values with scale or offset are touched after unpacking. A scale of 1/n is applied as
+        # division by n, which gives the rounded decimal value directly (2301 / 10 is 230.1) without
+        # the much slower round().
+        self.divided, self.scaled = [], []
+        for position, entity in enumerate(self.entities):
+            divisor = round(1 / entity.scale) if entity.scale else 0
+            if entity.scale != 1 and divisor > 1 and abs(divisor * entity.scale - 1) < 1e-9:
+                self.divided.append((position, divisor, entity.offset))
+            elif entity.scale != 1 or entity.offset:
+                self.scaled.append((position, entity.scale, scale_digits(entity.scale), entity.offset))
+
+    def decode(self, block):
+        # block holds the register data as received, two big-endian bytes per register
+        if len(self.layouts) == 1:
+            values = list(self.layouts[0].unpack_from(block))
+        else:
+            values = [value for layout in self.layouts for value in layout.unpack_from(block)]
+        for position, divisor, bias in self.divided:
+            values[position] = values[position] / divisor + bias
+        for position, scale, digits, bias in self.scaled:
+            values[position] = (values[position] if scale == 1 else round(values[position] * scale, digits)) + bias
+        return values
+
+class RecordDecoder:
+    # Decodes the values of a fixed list of entities from the data blocks of a cycle in one pass.
+    # Entities of register blocks use a compiled BlockDecoder per block, the others (pv, calc) are
+    # taken from their block one by one. Values of a missing block are None.
+
+    def __init__(self, entities, register_sources):
+        self.entities = tuple(entities)
+        self.blocks = []                  # (source, BlockDecoder, positions in entity order)
+        for source in register_sources:
+            members = [entity for entity in self.entities if entity.source == source]
+            if members:
+                decoder = BlockDecoder(members)
+                # Entities may appear twice (e.g. history and state), positions are assigned in order
+                free = {}
+                for position, entity in enumerate(self.entities):
+                    if entity.source == source:
+                        free.setdefault(entity, []).append(position)
+                self.blocks.append((source, decoder, [free[entity].pop(0) for entity in decoder.entities]))
+        compiled = {position for _, _, positions in self.blocks for position in positions}
+        # (position, entity) of the entities of value blocks
+        self.values = [(position, entity) for position, entity in enumerate(self.entities) if position not in compiled]
+
+    def decode(self, blocks):
+        record = [None] * len(self.entities)
+        for source, decoder, positions in self.blocks:
+            block = blocks[source]
+            if block is not None:
+                for position, value in zip(positions, decoder.decode(block)):
+                    record[position] = value
+        for position, entity in self.values:
+            block = blocks[entity.source]
+            if block is not None:
+                record[position] = decode(entity, block)
+        return record
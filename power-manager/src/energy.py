@@ -0,0 +1,66 @@
+import json
+import logging
+
+from storage import write_json
+
+ENERGY_COUNTERS = ("grid_import", "grid_export", "battery_charge", "battery_discharge")
+
+def split_energy(start, end, seconds):
+    # Energy in kWh of the positive and of the negative part of a power changing linearly from start
+    # to end (W) within seconds, a sign change is split at the zero crossing
+    if start >= 0 and end >= 0:
+        return (start + end) / 2 * seconds / 3.6e6, 0.0
+    if start <= 0 and end <= 0:
+        return 0.0, -(start + end) / 2 * seconds / 3.6e6
+    crossing = start / (start - end) * seconds
+    positive = (max(start, 0) * crossing + max(end, 0) * (seconds - crossing)) / 2 / 3.6e6
+    negative = (max(-start, 0) * crossing + max(-end, 0) * (seconds - crossing)) / 2 / 3.6e6
+    return positive, negative
+
+class EnergyCounters:
+    # Integrates the grid and battery power of the control cycles to energy totals in kWh.
+    # Two consecutive readings are joined by the trapezoidal rule at their exact timestamps, gaps longer
+    # than max_gap seconds (missing readings, restart) are not bridged. Grid power > 0 is import,
+    # battery power > 0 is discharging. The totals are persisted and continue after a restart.
+
+    def __init__(self, path, max_gap=60.0):
+        self.path = path
+        self.max_gap = max_gap
+        self.totals = dict.fromkeys(ENERGY_COUNTERS, 0.0)
+        self.last = None                  # (timestamp, grid power, battery power) of the last reading
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path, "r") as file:
+                stored = json.load(file)
+            for name in ENERGY_COUNTERS:
+                self.totals[name] = float(stored.get(name, 0.0))
+            logging.info(f"✅ Energy totals loaded from {self.path}")
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, AttributeError) as e:
+            logging.error(f"❌ Unable to read energy totals from {self.path}: {e}")
+
+    def save(self):
+        try:
+            write_json(self.path, self.totals)
+        except OSError as e:
+            logging.error(f"❌ Unable to store energy totals in {self.path}: {e}")
+
+    def update(self, timestamp, grid_power, battery_power):
+        if self.last is not None:
+            last_time, last_grid, last_battery = self.last
+            seconds = timestamp - last_time
+            if 0 < seconds <= self.max_gap:
+                imported, exported = split_energy(last_grid, grid_power, seconds)
+                discharged, charged = split_energy(last_battery, battery_power, seconds)
+                self.totals["grid_import"] += imported
+                self.totals["grid_export"] += exported
+                self.totals["battery_charge"] += charged
+                self.totals["battery_discharge"] += discharged
+        self.last = (timestamp, grid_power, battery_power)
+
+    def values(self):
+        # Published totals, Wh resolution
+        return {name: round(total, 3) for name, total in self.totals.items()}
@@ -0,0 +1,236 @@
+import hashlib
+import json
+import logging
+import math
+from collections import namedtuple
+from functools import lru_cache
+
+from metrics import STAGES, QUANTILES, COUNTERS, GAUGES
+from modbus import BREAKER_STATES, unsigned_to_signed
+from publisher import json_state_location
+from storage import write_json
+
+# Declarative description of all HA entities of the power manager. Topics are relative to the
+# power manager base topic. Entities with a source are published every cycle, the value is
+# taken from the named data block (sax, adl, pv or calc) at index and decoded with signed/scale/offset,
+# width is the number of registers of the value (2 for 32-bit values, high word first).
+# Entities without component are only published as state and get no discovery config.
+Entity = namedtuple("Entity", [
+    "component", "object_id", "name", "topic",
+    "unique_id", "source", "index", "signed", "scale", "offset",
+    "unit", "device_class", "state_class", "icon", "value_template", "deadband", "options", "width"
+], defaults=(None, None, None, False, 1, 0, None, None, None, None, "{{ value_json }}", None, None, 1))
+
+@lru_cache(maxsize=None)
+def scale_digits(scale):
+    # Decimal places of the register resolution, e.g. 2 for a scale of 0.01
+    return max(0, -math.floor(math.log10(scale) + 1e-9)) if scale else 0
+
+def decode(entity, block):
+    value = block[entity.index]
+    if entity.width == 2:
+        value = (value << 16) | block[entity.index + 1]
+    if entity.signed:
+        value = unsigned_to_signed(value, 16 * entity.width)
+    if entity.scale != 1:
+        # Rounded to the register resolution, 2301 * 0.1 gives 230.10000000000002 otherwise
+        value = round(value * entity.scale, scale_digits(entity.scale))
+    if entity.offset:
+        value = value + entity.offset
+    return value
+
+def _measurement(object_id, name, topic, unit, device_class, source, index, deadband=None, **kwargs):
+    return Entity("sensor", object_id, name, topic, source=source, index=index, unit=unit, device_class=device_class,
+                  state_class="measurement", deadband=deadband, **kwargs)
+
+DIAGNOSTIC = {"entity_category": "diagnostic"}
+
+ENTITIES = (
+    _measurement("battery_power", "Battery Power", "battery/power", "W", "power", "sax", 2, offset=-16384, deadband=(10, 0)),
+    _measurement("smartmeter_actpower_total", "SmartMeter Active Power Total", "smartmeter/power/active/total", "W", "power", "adl", 9, signed=True, deadband=(10, 0)),
+    Entity("sensor", "pv_power", "PV Power", "pv/power/total", source="pv", index=1, unit="W", device_class="power", state_class="measurement", deadband=(10, 0.02)),
+    Entity("sensor", "pv_state", "PV Operation Mode", "pv/state", source="pv", index=2, icon="mdi:state-machine"),
+    Entity("sensor", "pv_day_yield", "PV Day Yield", "pv/day_yield", source="pv", index=3, unit="kWh", device_class="energy", state_class="total_increasing",
+           value_template="{{ (value_json | float) / 1000 | round(1) }}", deadband=(10, 0)),
+    Entity("sensor", "pv_dc_power", "PV DC Power", "pv/power/dc_in", source="pv", index=0, unit="W", device_class="power", state_class="measurement", deadband=(10, 0.02)),
+    Entity("sensor", "smartmeter_power_factor_total", "SmartMeter Power Factor Total", "smartmeter/power-factor/total", source="adl", index=21, signed=True, scale=0.001,
+           state_class="measurement", deadband=(0.01, 0)),
+    _measurement("battery_target_power", "Battery Target Power", "battery/target_power", "W", "power", "calc", "target_power", deadband=(10, 0)),
+    Entity("sensor", "battery_state", "Battery Operation Mode", "battery/state", source="sax", index=0, icon="mdi:state-machine"),
+    Entity("sensor", "battery_soc", "Battery SoC", "battery/soc", source="sax", index=1, unit="%", device_class="battery"),
+    _measurement("battery_smpower", "Battery SmartMeter Power", "battery/smpower", "W", "power", "sax", 3, offset=-16384, deadband=(10, 0)),
+    _measurement("smartmeter_voltage_a", "SmartMeter Voltage Phase A", "smartmeter/voltage/A", "V", "voltage", "adl", 0, scale=0.1, deadband=(0.5, 0)),
+    _measurement("smartmeter_voltage_b", "SmartMeter Voltage Phase B", "smartmeter/voltage/B", "V", "voltage", "adl", 1, scale=0.1, deadband=(0.5, 0)),
+    _measurement("smartmeter_voltage_c", "SmartMeter Voltage Phase C", "smartmeter/voltage/C", "V", "voltage", "adl", 2, scale=0.1, deadband=(0.5, 0)),
+    _measurement("smartmeter_current_a", "SmartMeter Current Phase A", "smartmeter/current/A", "A", "current", "adl", 3, scale=0.01, deadband=(0.05, 0)),
+    _measurement("smartmeter_current_b", "SmartMeter Current Phase B", "smartmeter/current/B", "A", "current", "adl", 4, scale=0.01, deadband=(0.05, 0)),
+    _measurement("smartmeter_current_c", "SmartMeter Current Phase C", "smartmeter/current/C", "A", "current", "adl", 5, scale=0.01, deadband=(0.05, 0)),
+    _measurement("smartmeter_actpower_a", "SmartMeter Active Power Phase A", "smartmeter/power/active/A", "W", "power", "adl", 6, signed=True, deadband=(10, 0)),
+    _measurement("smartmeter_actpower_b", "SmartMeter Active Power Phase B", "smartmeter/power/active/B", "W", "power", "adl", 7, signed=True, deadband=(10, 0)),
+    _measurement("smartmeter_actpower_c", "SmartMeter Active Power Phase C", "smartmeter/power/active/C", "W", "power", "adl", 8, signed=True, deadband=(10, 0)),
+    Entity("sensor", "smartmeter_power_factor_a", "SmartMeter Power Factor Phase A", "smartmeter/power-factor/A", source="adl", index=18, signed=True, scale=0.001,
+           state_class="measurement", deadband=(0.01, 0)),
+    Entity("sensor", "smartmeter_power_factor_b", "SmartMeter Power Factor Phase B", "smartmeter/power-factor/B", source="adl", index=19, signed=True, scale=0.001,
+           state_class="measurement", deadband=(0.01, 0)),
+    Entity("sensor", "smartmeter_power_factor_c", "SmartMeter Power Factor Phase C", "smartmeter/power-factor/C", source="adl", index=20, signed=True, scale=0.001,
+           state_class="measurement", deadband=(0.01, 0)),
+    _measurement("smartmeter_frequency", "SmartMeter Frequency", "smartmeter/frequency", "Hz", "frequency", "adl", 22, scale=0.01, deadband=(0.02, 0)),
+    Entity("sensor", "cycle_interval", "Cycle Interval", "control/interval", source="calc", index="cycle_interval", unit="s", device_class="duration",
+           state_class="measurement", icon="mdi:timer-sync-outline", deadband=(0, 0.1), options=DIAGNOSTIC),
+    Entity("sensor", "battery_connection", "Battery Connection", "battery/connection", source="calc", index="sax_link", device_class="enum",
+           icon="mdi:lan-connect", options={**DIAGNOSTIC, "options": list(BREAKER_STATES)}),
+    Entity("sensor", "smartmeter_connection", "SmartMeter Connection", "smartmeter/connection", source="calc", index="adl_link", device_class="enum",
+           icon="mdi:lan-connect", options={**DIAGNOSTIC, "options": list(BREAKER_STATES)}),
+    Entity(None, None, None, "battery/request/time/actual", source="calc", index="sax_time", deadband=(0, 0.25)),
+    Entity(None, None, None, "smartmeter/request/time/actual", source="calc", index="adl_time", deadband=(0, 0.25)),
+    Entity("button", "battery_power_on", "Battery Power On", "battery/power-cmd", icon="mdi:power-on", options={"payload_press": "ON"}),
+    Entity("button", "battery_power_off", "Battery Power Off", "battery/power-cmd", icon="mdi:power-off", options={"payload_press": "OFF"}),
+    Entity("switch", "battery_grid", "Battery Grid Loading", "battery/grid-loading", unique_id="pm_battery_grid_loading_switch", device_class="switch",
+           options={"qos": 1, "retain": True}),
+    Entity("number", "emergency_power_reserve", "Emergency Power Reserve", "battery/emergency-power-reserve", unique_id="pm_emergency_power_reserve_number", unit="%",
+           options={"qos": 1, "retain": True, "min": "0", "max": "90", "mode": "slider"}),
+    Entity("number", "limit_charging", "Charging limit", "battery/charging-limit", unique_id="pm_charging_limit_number", unit="W", device_class="power",
+           options={"qos": 1, "retain": True, "min": 0, "max": 3500, "mode": "slider", "step": 50}),
+    Entity("number", "limit_discharging", "Discharging limit", "battery/discharging-limit", unique_id="pm_discharging_limit_number", unit="W", device_class="power",
+           options={"qos": 1, "retain": True, "min": 0, "max": 4600, "mode": "slider", "step": 50}),
+    Entity("number", "prio_charging", "Prioritized charging power", "battery/prio-charging", unique_id="pm_prio_charging_number", unit="W", device_class="power",
+           options={"qos": 1, "retain": True, "min": 0, "max": 3500, "mode": "slider", "step": 50}),
+)
+
+# Energy totals integrated from the power readings, published periodically
+ENERGY_ENTITIES = tuple(
+    Entity("sensor", f"{counter}_energy", name, f"energy/{counter}", source="energy", index=counter,
+           unit="kWh", device_class="energy", state_class="total_increasing")
+    for counter, name in (("grid_import", "Grid Import Energy"), ("grid_export", "Grid Export Energy"),
+                          ("battery_charge", "Battery Charge Energy"), ("battery_discharge", "Battery Discharge Energy"))
+)
+
+# Latency quantiles and event counters, published periodically from the metrics
+METRIC_ENTITIES = tuple(
+    Entity("sensor", f"metrics_{stage}_{name}", f"{label} Latency {name.upper()}", f"metrics/{stage}/{name}", source="metrics", index=f"{stage}_{name}",
+           unit="ms", state_class="measurement", icon="mdi:timer-outline", options=DIAGNOSTIC)
+    for stage, label in STAGES.items() for name in (*QUANTILES, "max")
+) + tuple(
+    Entity("sensor", f"metrics_{counter}", label, f"metrics/{counter}", source="metrics", index=counter,
+           state_class="total_increasing", icon="mdi:counter", options=DIAGNOSTIC)
+    for counter, label in COUNTERS.items()
+) + tuple(
+    Entity("sensor", f"metrics_{gauge}", label, f"metrics/{gauge}", source="metrics", index=gauge,
+           unit="ms", device_class="duration", state_class="measurement", icon="mdi:timer-play-outline", options=DIAGNOSTIC)
+    for gauge, label in GAUGES.items()
+)
+
+# Reactive and apparent power of the ADL400, only read and published if enabled
+REACTIVE_ENTITIES = (
+    _measurement("smartmeter_reactpower_a", "SmartMeter Reactive Power Phase A", "smartmeter/power/reactive/A", "var", "reactive_power", "adl", 10, signed=True, deadband=(10, 0)),
+    _measurement("smartmeter_reactpower_b", "SmartMeter Reactive Power Phase B", "smartmeter/power/reactive/B", "var", "reactive_power", "adl", 11, signed=True, deadband=(10, 0)),
+    _measurement("smartmeter_reactpower_c", "SmartMeter Reactive Power Phase C", "smartmeter/power/reactive/C", "var", "reactive_power", "adl", 12, signed=True, deadband=(10, 0)),
+    _measurement("smartmeter_reactpower_total", "SmartMeter Reactive Power Total", "smartmeter/power/reactive/total", "var", "reactive_power", "adl", 13, signed=True, deadband=(10, 0)),
+    _measurement("smartmeter_apppower_a", "SmartMeter Apparent Power Phase A", "smartmeter/power/apparent/A", "VA", "apparent_power", "adl", 14, signed=True, deadband=(10, 0)),
+    _measurement("smartmeter_apppower_b", "SmartMeter Apparent Power Phase B", "smartmeter/power/apparent/B", "VA", "apparent_power", "adl", 15, signed=True, deadband=(10, 0)),
+    _measurement("smartmeter_apppower_c", "SmartMeter Apparent Power Phase C", "smartmeter/power/apparent/C", "VA", "apparent_power", "adl", 16, signed=True, deadband=(10, 0)),
+    _measurement("smartmeter_apppower_total", "SmartMeter Apparent Power Total", "smartmeter/power/apparent/total", "VA", "apparent_power", "adl", 17, signed=True, deadband=(10, 0)),
+)
+
+# Totals over all units, only used with more than one battery
+COMBINED_ENTITIES = (
+    _measurement("batteries_power", "Batteries Power", "batteries/power", "W", "power", "calc", "batteries_power", deadband=(10, 0)),
+    _measurement("batteries_target_power", "Batteries Target Power", "batteries/target_power", "W", "power", "calc", "batteries_target_power", deadband=(10, 0)),
+    Entity("sensor", "batteries_soc", "Batteries SoC", "batteries/soc", source="calc", index="batteries_soc", unit="%", device_class="battery", deadband=(1, 0)),
+)
+
+STATE_ENTITIES = tuple(entity for entity in ENTITIES if entity.source is not None)
+
+def battery_entities(number):
+    # State entities of an additional battery unit, derived from those of the first unit
+    return tuple(
+        entity._replace(object_id=entity.object_id.replace("battery", f"battery{number}", 1),
+                        name=entity.name.replace("Battery", f"Battery {number}", 1),
+                        topic=entity.topic.replace("battery/", f"battery{number}/", 1),
+                        source=f"sax{number}" if entity.source == "sax" else entity.source,
+                        index=f"{entity.index}{number}" if entity.source == "calc" else entity.index)
+        for entity in STATE_ENTITIES if entity.source == "sax" or entity.index in ("target_power", "sax_link")
+    )
+
+def unit_entities(units):
+    # Entities added to the single battery entities for the given number of battery units
+    if units <= 1:
+        return ()
+    return sum((battery_entities(number) for number in range(2, units + 1)), ()) + COMBINED_ENTITIES
+
+def extra_entities(units, reactive_power=False):
+    # Entities added to the base entities for the battery units and the optional ADL400 telemetry
+    return unit_entities(units) + (REACTIVE_ENTITIES if reactive_power else ())
+
+def aggregate_entities(entities):
+    # Min and max entities of the telemetry entities aggregated over a window
+    return tuple(
+        entity._replace(object_id=f"{entity.object_id}_{name}", name=f"{entity.name} {label}", topic=f"{entity.topic}/{name}",
+                        source="aggregate", index=name)
+        for entity in entities for name, label in (("min", "Min"), ("max", "Max"))
+    )
+
+def history_entities(entities):
+    # State entities with numeric values, recorded in the history
+    return tuple(entity for entity in entities if entity.device_class != "enum")
+
+def history_signals(entities):
+    # Signal names of the state entities in the recorded history
+    return tuple(entity.object_id or entity.index for entity in history_entities(entities))
+
+def state_deadbands(base_topic, entities=STATE_ENTITIES):
+    return tuple((f"{base_topic}/{entity.topic}", *entity.deadband) for entity in entities if entity.deadband)
+
+def discovery_config(entity, uuid, device, base_topic, json_state=False):
+    config = {
+        "name": entity.name,
+        "unique_id": f"{uuid}_{entity.unique_id or 'pm_' + entity.object_id}",
+    }
+    if entity.icon is not None:
+        config["icon"] = entity.icon
+    topic = f"{base_topic}/{entity.topic}"
+    if entity.component == "sensor":
+        value_template = entity.value_template
+        if json_state:
+            # State is published as JSON document per device, the entity extracts its field
+            topic, field = json_state_location(base_topic, topic)
+            value_template = value_template.replace("value_json", f"value_json.{field}")
+        config["state_topic"] = topic
+        config["value_template"] = value_template
+    else:
+        config["command_topic"] = topic
+    if entity.unit is not None:
+        config["unit_of_measurement"] = entity.unit
+    if entity.device_class is not None:
+        config["device_class"] = entity.device_class
+    if entity.state_class is not None:
+        config["state_class"] = entity.state_class
+    if entity.options:
+        config.update(entity.options)
+    config["device"] = device
+    return config
+
+def build_discovery(uuid, device, discovery_prefix, base_topic, json_state=False, entities=ENTITIES + METRIC_ENTITIES):
+    # Returns the pre-serialized discovery messages as list of (topic, payload)
+    return [(f"{discovery_prefix}/{entity.component}/{uuid}/{entity.object_id}/config",
+             json.dumps(discovery_config(entity, uuid, device, base_topic, json_state)))
+            for entity in entities if entity.component is not None]
+
+def discovery_digest(payload):
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def load_discovery_hashes(path):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+    except (OSError, ValueError) as e:
+        logging.error(f"❌ Unable to read discovery hashes from {path}: {e}")
+        return {}
+
+def save_discovery_hashes(path, hashes):
+    try:
+        write_json(path, hashes)
+    except OSError as e:
+        logging.error(f"❌ Unable to store discovery hashes in {path}: {e}")
@@ -0,0 +1,129 @@
+import hashlib
+import logging
+import math
+import mmap
+import os
+import struct
+
+HISTORY_MAGIC = b"PMHIST01"
+# Magic, capacity, number of signals, next write position, number of samples, schema digest
+HEADER = struct.Struct("<8sIIQQ32s")
+HEADER_SIZE = 64
+NAN = float("nan")
+
+class History:
+    # Ring buffer of the recorded cycles in a memory-mapped file. The file holds one float64 column
+    # with the timestamps and one float32 column per signal, so a sample costs 8 + 4 * signals bytes
+    # and no Python objects are kept per sample. Missing values are stored as NaN.
+    # Timestamps are wall clock seconds and must not decrease, windowed queries use a binary search.
+
+    def __init__(self, path, signals, capacity):
+        self.path = path
+        self.signals = tuple(signals)
+        self.columns = {name: position for position, name in enumerate(self.signals)}
+        self.capacity = capacity
+        self.schema = hashlib.sha256("\n".join(self.signals).encode()).digest()
+        self.size = HEADER_SIZE + capacity * 8 + capacity * 4 * len(self.signals)
+        self.head = 0
+        self.count = 0
+        self._open()
+
+    def _open(self):
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            reuse = False
+            if os.fstat(fd).st_size == self.size:
+                magic, capacity, signals, head, count, schema = HEADER.unpack(os.pread(fd, HEADER.size, 0))
+                reuse = (magic == HISTORY_MAGIC and capacity == self.capacity and signals == len(self.signals)
+                         and schema == self.schema and head < capacity and count <= capacity)
+            if not reuse:
+                if os.fstat(fd).st_size:
+                    logging.info(f"History layout in {self.path} changed, starting a new history")
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, self.size)
+            self.mmap = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        if reuse:
+            _, _, _, self.head, self.count, _ = HEADER.unpack_from(self.mmap, 0)
+        else:
+            self.head, self.count = 0, 0
+            self._write_header()
+        self.times = memoryview(self.mmap)[HEADER_SIZE:HEADER_SIZE + self.capacity * 8].cast("d")
+        offset = HEADER_SIZE + self.capacity * 8
+        self.values = [memoryview(self.mmap)[offset + column * self.capacity * 4:offset + (column + 1) * self.capacity * 4].cast("f")
+                       for column in range(len(self.signals))]
+        logging.info(f"✅ History with {self.count} of {self.capacity} samples loaded from {self.path}")
+
+    def _write_header(self):
+        HEADER.pack_into(self.mmap, 0, HISTORY_MAGIC, self.capacity, len(self.signals), self.head, self.count, self.schema)
+
+    @property
+    def last_time(self):
+        return self.times[(self.head - 1) % self.capacity] if self.count else None
+
+    def append(self, timestamp, values):
+        # values are in the order of the signals, None is stored as NaN
+        position = self.head
+        self.times[position] = timestamp
+        for column, value in zip(self.values, values):
+            column[position] = NAN if value is None else value
+        self.head = (position + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+        self._write_header()
+
+    def _segments(self, start):
+        # Physical (begin, end) ranges of the logical samples start..count-1, oldest first
+        first = (self.head - self.count) % self.capacity
+        begin = first + start
+        end = first + self.count
+        if end <= self.capacity:
+            return [(begin, end)]
+        if begin >= self.capacity:
+            return [(begin - self.capacity, end - self.capacity)]
+        return [(begin, self.capacity), (0, end - self.capacity)]
+
+    def _first_since(self, since):
+        # Logical index of the first sample with a timestamp >= since
+        first = (self.head - self.count) % self.capacity
+        lower, upper = 0, self.count
+        while lower < upper:
+            middle = (lower + upper) // 2
+            if self.times[(first + middle) % self.capacity] < since:
+                lower = middle + 1
+            else:
+                upper = middle
+        return lower
+
+    def series(self, signal, seconds, now):
+        # List of (timestamp, value) of the signal in the last seconds before now, missing values skipped
+        column = self.values[self.columns[signal]]
+        result = []
+        for begin, end in self._segments(self._first_since(now - seconds)):
+            result.extend((t, v) for t, v in zip(self.times[begin:end], column[begin:end]) if v == v)
+        return result
+
+    def stats(self, signal, seconds, now):
+        # (min, mean, max, count) of the signal in the last seconds before now, None without samples
+        column = self.values[self.columns[signal]]
+        lowest, highest, total, count = math.inf, -math.inf, 0.0, 0
+        for begin, end in self._segments(self._first_since(now - seconds)):
+            samples = [v for v in column[begin:end] if v == v]
+            if samples:
+                lowest = min(lowest, min(samples))
+                highest = max(highest, max(samples))
+                total += math.fsum(samples)
+                count += len(samples)
+        if not count:
+            return None
+        return lowest, total / count, highest, count
+
+    def flush(self):
+        self.mmap.flush()
+
+    def close(self):
+        self.flush()
+        self.times.release()
+        for column in self.values:
+            column.release()
+        self.mmap.close()
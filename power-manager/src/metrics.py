@@ -0,0 +1,121 @@
+import asyncio
+import logging
+from collections import deque
+
+STAGES = {
+    "sax_read": "SAX Read",
+    "adl_read": "ADL Read",
+    "setpoint_write": "Setpoint Write",
+    "pv_fetch": "PV Fetch",
+    "mqtt_publish": "MQTT Publish",
+    "cycle": "Cycle",
+}
+QUANTILES = {"p50": 0.5, "p95": 0.95, "p99": 0.99}
+COUNTERS = {
+    "sax_read_retries": "SAX Read Retries",
+    "sax_read_failures": "SAX Read Failures",
+    "adl_read_retries": "ADL Read Retries",
+    "adl_read_failures": "ADL Read Failures",
+    "setpoint_write_failures": "Setpoint Write Failures",
+    "pv_fetch_failures": "PV Fetch Failures",
+    "mqtt_reconnects": "MQTT Reconnects",
+    "mqtt_dropped": "MQTT Buffered Messages Dropped",
+}
+GAUGES = {
+    "first_setpoint": "Time to First Setpoint",
+}
+
+class RollingHistogram:
+    # Keeps the last window samples for quantiles plus totals since start
+    def __init__(self, window):
+        self.samples = deque(maxlen=window)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def quantiles(self):
+        ordered = sorted(self.samples)
+        if not ordered:
+            return None
+        result = {name: ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] for name, fraction in QUANTILES.items()}
+        result["max"] = ordered[-1]
+        return result
+
+class Metrics:
+    def __init__(self, window=1000):
+        self.histograms = {stage: RollingHistogram(window) for stage in STAGES}
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.gauges = {}
+
+    def observe(self, stage, milliseconds):
+        self.histograms[stage].observe(milliseconds)
+
+    def increment(self, counter, value=1):
+        self.counters[counter] += value
+
+    def set(self, gauge, milliseconds):
+        self.gauges[gauge] = milliseconds
+
+    def values(self):
+        # Flat dict of all current values as published to HA, e.g. cycle_p95 or sax_read_retries
+        values = dict(self.counters)
+        values.update((gauge, round(value, 3)) for gauge, value in self.gauges.items())
+        for stage, histogram in self.histograms.items():
+            quantiles = histogram.quantiles()
+            if quantiles is not None:
+                for name, value in quantiles.items():
+                    values[f"{stage}_{name}"] = round(value, 3)
+        return values
+
+    def prometheus(self):
+        lines = [
+            "# HELP pwrmgr_stage_latency_ms Latency of the stages of the control cycle in milliseconds",
+            "# TYPE pwrmgr_stage_latency_ms summary",
+        ]
+        for stage, histogram in self.histograms.items():
+            quantiles = histogram.quantiles()
+            if quantiles is not None:
+                for name, fraction in QUANTILES.items():
+                    lines.append(f'pwrmgr_stage_latency_ms{{stage="{stage}",quantile="{fraction}"}} {quantiles[name]:.3f}')
+            lines.append(f'pwrmgr_stage_latency_ms_sum{{stage="{stage}"}} {histogram.total:.3f}')
+            lines.append(f'pwrmgr_stage_latency_ms_count{{stage="{stage}"}} {histogram.count}')
+        lines.append("# HELP pwrmgr_stage_latency_max_ms Maximum latency within the rolling window in milliseconds")
+        lines.append("# TYPE pwrmgr_stage_latency_max_ms gauge")
+        for stage, histogram in self.histograms.items():
+            if histogram.samples:
+                lines.append(f'pwrmgr_stage_latency_max_ms{{stage="{stage}"}} {max(histogram.samples):.3f}')
+        lines.append("# HELP pwrmgr_events_total Retries and failures of device requests")
+        lines.append("# TYPE pwrmgr_events_total counter")
+        for counter, value in self.counters.items():
+            lines.append(f'pwrmgr_events_total{{event="{counter}"}} {value}')
+        if self.gauges:
+            lines.append("# HELP pwrmgr_startup_ms Milliseconds from the start of the power manager to the named event")
+            lines.append("# TYPE pwrmgr_startup_ms gauge")
+            for gauge, value in self.gauges.items():
+                lines.append(f'pwrmgr_startup_ms{{event="{gauge}"}} {value:.3f}')
+        return "\n".join(lines) + "\n"
+
+    async def _handle(self, reader, writer):
+        try:
+            request = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+            path = request.split(b" ", 2)[1] if request.count(b" ") >= 2 else b""
+            if path in (b"/metrics", b"/"):
+                status, body = b"200 OK", self.prometheus().encode()
+            else:
+                status, body = b"404 Not Found", b"Not Found\n"
+            writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: "
+                         + str(len(body)).encode() + b"\r\nConnection: close\r\n\r\n" + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, port, host="0.0.0.0"):
+        server = await asyncio.start_server(self._handle, host, port)
+        logging.info(f"✅ Metrics available on http://{host}:{port}/metrics")
+        return server
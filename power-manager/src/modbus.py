@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import struct
+import time
+
+FC_READ_HOLDING_REGISTERS = 0x03
+FC_WRITE_MULTIPLE_REGISTERS = 0x10
+MBAP_MAX_LENGTH = 254              # Length field of the MBAP header: unit id and a PDU of at most 253 bytes
+
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+BREAKER_STATES = (BREAKER_CLOSED, BREAKER_OPEN, BREAKER_HALF_OPEN)
+
+class CircuitBreaker:
+    # Connection state of one device. After failure_threshold consecutive failed requests the breaker
+    # opens and requests fail immediately until the backoff passed. Then one probe request is let
+    # through on a new connection (half open): success closes the breaker, failure opens it again
+    # with the doubled backoff up to max_backoff.
+
+    def __init__(self, name, failure_threshold=3, backoff=1.0, max_backoff=10.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.min_backoff = backoff
+        self.max_backoff = max_backoff
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.backoff = backoff
+        self.retry_at = 0.0
+
+    def allow(self, now):
+        if self.state == BREAKER_OPEN and now >= self.retry_at:
+            self.state = BREAKER_HALF_OPEN
+            return True
+        return self.state == BREAKER_CLOSED or self.state == BREAKER_HALF_OPEN
+
+    def retry_in(self, now):
+        return max(0.0, self.retry_at - now) if self.state == BREAKER_OPEN else 0.0
+
+    def success(self):
+        if self.state != BREAKER_CLOSED:
+            logging.info(f"✅ Connection to {self.name} recovered.")
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.backoff = self.min_backoff
+
+    def failure(self, now):
+        self.failures += 1
+        if self.state == BREAKER_HALF_OPEN:
+            self.backoff = min(self.backoff * 2, self.max_backoff)
+        elif self.failures < self.failure_threshold:
+            return
+        else:
+            logging.error(f"❌ Connection to {self.name} lost, retrying in {self.backoff:.0f}s.")
+        self.state = BREAKER_OPEN
+        self.retry_at = now + self.backoff
+
+class AsyncModbusClient:
+    # Minimal asyncio-native Modbus TCP client. Requests on one connection are serialized,
+    # different devices use their own client and can be queried concurrently.
+    # An optional circuit breaker rejects requests while the device is unreachable.
+
+    def __init__(self, host, port=502, unit_id=1, timeout=5.0, breaker=None):
+        self.host = host
+        self.port = port
+        self.unit_id = unit_id
+        self.timeout = timeout
+        self.breaker = breaker
+        self._reader = None
+        self._writer = None
+        self._transaction_id = 0
+        self._lock = asyncio.Lock()
+
+    @property
+    def is_open(self):
+        return self._writer is not None and not self._writer.is_closing()
+
+    async def open(self):
+        if self.is_open:
+            return True
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(self.host, self.port), self.timeout)
+            return True
+        except (OSError, asyncio.TimeoutError) as e:
+            logging.debug(f"Modbus connect to {self.host}:{self.port} failed: {e}")
+            self._reader = None
+            self._writer = None
+            return False
+
+    async def close(self):
+        writer = self._writer
+        self._reader = None
+        self._writer = None
+        if writer is not None:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except OSError:
+                pass
+
+    async def read_holding_registers(self, address, count):
+        data = await self.read_holding_register_bytes(address, count)
+        return None if data is None else list(struct.unpack(f">{count}H", data))
+
+    async def read_holding_register_bytes(self, address, count):
+        # Register data of the response as received, two big-endian bytes per register
+        pdu = await self._request(struct.pack(">BHH", FC_READ_HOLDING_REGISTERS, address, count))
+        if pdu is None or len(pdu) < 2 or pdu[1] != 2 * count or len(pdu) != 2 + 2 * count:
+            return None
+        return pdu[2:]
+
+    async def write_multiple_registers(self, address, values):
+        count = len(values)
+        pdu = await self._request(struct.pack(f">BHHB{count}H", FC_WRITE_MULTIPLE_REGISTERS, address, count, 2 * count, *values))
+        return pdu is not None
+
+    @property
+    def available(self):
+        return self.breaker is None or self.breaker.state != BREAKER_OPEN
+
+    async def _request(self, pdu):
+        async with self._lock:
+            if self.breaker is None:
+                return await self._transfer(pdu)
+            if not self.breaker.allow(time.monotonic()):
+                return None
+            if self.breaker.state == BREAKER_HALF_OPEN:
+                # Probe on a fresh socket, the old one may be half dead
+                await self.close()
+            response = await self._transfer(pdu)
+            if response is None:
+                self.breaker.failure(time.monotonic())
+            else:
+                self.breaker.success()
+            return response
+
+    async def _transfer(self, pdu):
+        if not self.is_open and not await self.open():
+            return None
+        self._transaction_id = (self._transaction_id + 1) & 0xFFFF
+        frame = struct.pack(">HHHB", self._transaction_id, 0, len(pdu) + 1, self.unit_id) + pdu
+        try:
+            self._writer.write(frame)
+            await asyncio.wait_for(self._writer.drain(), self.timeout)
+            header = await asyncio.wait_for(self._reader.readexactly(7), self.timeout)
+            transaction_id, protocol_id, length, _ = struct.unpack(">HHHB", header)
+            if not 1 <= length <= MBAP_MAX_LENGTH:
+                # Not a Modbus frame, the rest of the stream cannot be parsed any more
+                logging.debug(f"Modbus response from {self.host}:{self.port} with invalid length {length}")
+                await self.close()
+                return None
+            response = await asyncio.wait_for(self._reader.readexactly(length - 1), self.timeout)
+        except (OSError, asyncio.IncompleteReadError, asyncio.TimeoutError) as e:
+            logging.debug(f"Modbus request to {self.host}:{self.port} failed: {e!r}")
+            await self.close()
+            return None
+
+        # SAX always returns a wrong transaction id, requests are serialized so the response is accepted anyway
+        if transaction_id != self._transaction_id:
+            logging.debug(f"Modbus transaction id mismatch from {self.host}: {transaction_id} != {self._transaction_id}")
+        if protocol_id != 0 or not response:
+            return None
+        if response[0] != pdu[0]:
+            if response[0] == pdu[0] | 0x80 and len(response) > 1:
+                logging.debug(f"Modbus exception {response[1]} from {self.host} for function {pdu[0]}")
+            return None
+        return response
+
+def unsigned_to_signed(unsigned_value, bits=16):
+    max_unsigned = 2 ** bits
+    max_signed = 2 ** (bits - 1)
+    return unsigned_value if unsigned_value < max_signed else unsigned_value - max_unsigned
+
+class WriteCache:
+    # Remembers the last values written per device register. A write is only due if a value moved
+    # beyond the tolerance or the last write is older than the keep-alive interval.
+
+    def __init__(self, keepalive=10):
+        self.keepalive = keepalive
+        self.suppressed = 0
+        self._last = {}                   # (host, port, unit id, register) => (values, timestamp)
+
+    def is_due(self, key, values, now, tolerance=0, keepalive=None):
+        last = self._last.get(key)
+        if last is None:
+            return True
+        last_values, last_time = last
+        if now - last_time >= (self.keepalive if keepalive is None else keepalive):
+            return True
+        if len(values) != len(last_values):
+            return True
+        return any(abs(unsigned_to_signed(value) - unsigned_to_signed(last_value)) > tolerance for value, last_value in zip(values, last_values))
+
+    def mark_written(self, key, values, now):
+        self._last[key] = (list(values), now)
+
+    def invalidate(self, key=None):
+        if key is None:
+            self._last.clear()
+        else:
+            self._last.pop(key, None)
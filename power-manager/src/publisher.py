@@ -0,0 +1,146 @@
+import asyncio
+import json
+import time
+
+def json_state_location(base_topic, topic):
+    # Maps a state topic below base_topic to (JSON document topic, field), e.g.
+    # <base>/smartmeter/power/active/A => (<base>/smartmeter/json, power_active_a)
+    device, _, path = topic[len(base_topic) + 1:].partition("/")
+    return f"{base_topic}/{device}/json", path.replace("/", "_").replace("-", "_").lower()
+
+class OutboundBuffer:
+    # Latest payload per topic of the messages that could not be sent while the MQTT session is down.
+    # A newer message replaces the buffered one of its topic, so the backlog never holds more than
+    # one message per topic. Beyond capacity topics the least recently updated topic is dropped.
+
+    def __init__(self, capacity=1000):
+        self.capacity = capacity
+        self._messages = {}               # topic => (payload, retain), least recently updated first
+
+    def __len__(self):
+        return len(self._messages)
+
+    def put(self, topic, payload, retain=False):
+        # True if the buffer was full and the oldest topic was dropped
+        self._messages.pop(topic, None)
+        self._messages[topic] = (payload, retain)
+        if len(self._messages) > self.capacity:
+            del self._messages[next(iter(self._messages))]
+            return True
+        return False
+
+    def take(self):
+        messages, self._messages = self._messages, {}
+        return messages
+
+    def restore(self, messages):
+        # Puts taken messages back that could not be sent, newer buffered values of a topic are kept
+        restored = {topic: message for topic, message in messages.items() if topic not in self._messages}
+        self._messages = {**restored, **self._messages}
+        while len(self._messages) > self.capacity:
+            del self._messages[next(iter(self._messages))]
+
+class ChangePublisher:
+    # Keeps the last published value per topic and only forwards a new value if it left the
+    # deadband of the topic or if the last publish is older than max_age seconds.
+    # Values of a cycle can be queued and flushed as one concurrent batch. If json_base_topic is set,
+    # a batch is published as one JSON document per device instead of one message per topic. A retained
+    # document replaces the previous one, so the fields of a batch are merged into the last document.
+
+    def __init__(self, send, deadbands=(), max_age=60, deadband_factor=1.0, json_base_topic=None):
+        self.send = send
+        self.json_base_topic = json_base_topic
+        self.deadbands = deadbands        # Sequence of (topic prefix, absolute, relative)
+        self.max_age = max_age
+        self.deadband_factor = deadband_factor
+        self.suppressed = 0
+        self._last = {}                   # topic => (value, timestamp)
+        self._bands = {}                  # topic => (absolute, relative)
+        self._batch = {}                  # topic => (payload, retain)
+        self._documents = {}              # JSON document topic => fields of the last published document
+
+    def _band(self, topic):
+        band = self._bands.get(topic)
+        if band is None:
+            band = (0.0, 0.0)
+            for prefix, absolute, relative in self.deadbands:
+                if topic.startswith(prefix):
+                    band = (absolute * self.deadband_factor, relative * self.deadband_factor)
+                    break
+            self._bands[topic] = band
+        return band
+
+    def is_due(self, topic, value, now=None):
+        last = self._last.get(topic)
+        if last is None:
+            return True
+        last_value, last_time = last
+        if (now or time.monotonic()) - last_time >= self.max_age:
+            return True
+        if isinstance(value, (int, float)) and isinstance(last_value, (int, float)):
+            absolute, relative = self._band(topic)
+            return abs(value - last_value) > max(absolute, relative * abs(last_value))
+        return value != last_value
+
+    def mark_published(self, topic, value, now=None):
+        self._last[topic] = (value, now or time.monotonic())
+
+    def invalidate(self, topic=None):
+        if topic is None:
+            self._last.clear()
+        else:
+            self._last.pop(topic, None)
+
+    async def publish(self, topic, payload, retain=True):
+        now = time.monotonic()
+        if not self.is_due(topic, payload, now):
+            self.suppressed += 1
+            return False
+        if await self.send(topic=topic, payload=payload, retain=retain):
+            self.mark_published(topic, payload, now)
+            return True
+        return False
+
+    def queue(self, topic, payload, retain=True):
+        self._batch[topic] = (payload, retain)
+
+    async def flush(self):
+        batch, self._batch = self._batch, {}
+        if not batch:
+            return 0
+        if self.json_base_topic is not None:
+            return await self._flush_json(batch)
+        now = time.monotonic()
+        due = []
+        for topic, (payload, retain) in batch.items():
+            if self.is_due(topic, payload, now):
+                due.append((topic, payload, retain))
+            else:
+                self.suppressed += 1
+        results = await asyncio.gather(*(self.send(topic=topic, payload=payload, retain=retain) for topic, payload, retain in due))
+        for (topic, payload, _), sent in zip(due, results):
+            if sent:
+                self.mark_published(topic, payload, now)
+        return sum(results)
+
+    async def _flush_json(self, batch):
+        now = time.monotonic()
+        documents = {}
+        for topic, (payload, retain) in batch.items():
+            doc_topic, field = json_state_location(self.json_base_topic, topic)
+            document = documents.setdefault(doc_topic, {"fields": {}, "topics": [], "due": False, "retain": retain})
+            document["fields"][field] = payload
+            document["topics"].append((topic, payload))
+            if self.is_due(topic, payload, now):
+                document["due"] = True
+        due = [(doc_topic, document) for doc_topic, document in documents.items() if document["due"]]
+        self.suppressed += len(documents) - len(due)
+        for doc_topic, document in due:
+            # Fields not in this batch keep their last value instead of vanishing from the document
+            document["fields"] = self._documents[doc_topic] = {**self._documents.get(doc_topic, {}), **document["fields"]}
+        results = await asyncio.gather(*(self.send(topic=doc_topic, payload=json.dumps(document["fields"]), retain=document["retain"]) for doc_topic, document in due))
+        for (_, document), sent in zip(due, results):
+            if sent:
+                for topic, payload in document["topics"]:
+                    self.mark_published(topic, payload, now)
+        return sum(results)
@@ -0,0 +1,107 @@
+import asyncio
+import logging
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+PV_DXS_ENTRIES = (33556736, 67109120, 16780032, 251658754)   # DC power, AC power, state, day yield
+
+class PvCache:
+    # Last good values received from one inverter, a failed request keeps them until they are stale
+    def __init__(self, max_age):
+        self.values = None
+        self.timestamp = None
+        self.max_age = max_age
+
+    def update(self, values):
+        self.values = values
+        self.timestamp = time.monotonic()
+
+    @property
+    def age(self):
+        return None if self.timestamp is None else time.monotonic() - self.timestamp
+
+    @property
+    def stale(self):
+        return self.timestamp is None or self.age > self.max_age
+
+class Inverter:
+    # One PV inverter with its own persistent keep-alive HTTP session and request timeout
+    def __init__(self, number, url, user, password, timeout, max_age):
+        self.name = "PV" if number == 1 else f"PV {number}"
+        self.url = f"{url}/api/dxs.json?" + "&".join(f"dxsEntries={entry}" for entry in PV_DXS_ENTRIES)
+        self.timeout = timeout
+        self.cache = PvCache(max_age)
+        self.session = requests.Session()
+        self.session.auth = (user, password)
+        self.session.mount("http://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=1))
+
+    def fetch(self):
+        logging.debug("Sending REST request to %s", self.url)
+        starttime = time.time()
+        response = self.session.get(self.url, timeout=self.timeout, verify=True)
+        response.raise_for_status()
+        data = response.json()
+        totaltime = (time.time() - starttime) * 1000
+        logging.debug("Received REST response: %s", response.text)
+        entries = data.get("dxsEntries", [])
+        if len(entries) != len(PV_DXS_ENTRIES):
+            return None, totaltime
+        return [entry.get("value") for entry in entries], totaltime
+
+    def close(self):
+        self.session.close()
+
+def aggregate_pv(values):
+    # DC power, AC power and day yield are summed over the inverters with values, the state is the one of
+    # the first of them (inverter 1 unless it never answered)
+    if not values:
+        return [0, 0, 0, 0]
+    return [sum(entries[0] or 0 for entries in values), sum(entries[1] or 0 for entries in values),
+            values[0][2], sum(entries[3] or 0 for entries in values)]
+
+class PvPoller:
+    # Polls all inverters concurrently as a scheduled background job. The blocking requests run in
+    # worker threads so the event loop is never blocked, each inverter has its own timeout so a slow
+    # or unreachable inverter does not hold back the others. values are the totals over the last good
+    # values of all inverters, stale is set as soon as one inverter has no recent values.
+
+    def __init__(self, inverters, interval, timeout=10, metrics=None):
+        max_age = max(3 * interval, timeout)
+        self.inverters = [Inverter(number, url, user, password, timeout, max_age) for number, (url, user, password) in enumerate(inverters, start=1)]
+        self.interval = interval
+        self.metrics = metrics
+        self.values = [0, 0, 0, 0]
+
+    @property
+    def stale(self):
+        return any(inverter.cache.stale for inverter in self.inverters)
+
+    async def poll(self):
+        await asyncio.gather(*(self.poll_inverter(inverter) for inverter in self.inverters))
+        self.values = aggregate_pv([inverter.cache.values for inverter in self.inverters if inverter.cache.values is not None])
+
+    async def poll_inverter(self, inverter):
+        try:
+            values, totaltime = await asyncio.to_thread(inverter.fetch)
+            if self.metrics is not None:
+                self.metrics.observe("pv_fetch", totaltime)
+            if values is not None:
+                inverter.cache.update(values)
+                logging.debug("%s data fetching terminated in %.3fms: DC Power %sW / AC Power %sW / State %s", inverter.name, totaltime, values[0], values[1], values[2])
+            else:
+                logging.error(f"REST request to {inverter.name} failed: Missing entries")
+                self.count_failure()
+        except (requests.exceptions.RequestException, ValueError) as e:
+            logging.error(f"REST request to {inverter.name} failed: {e}")
+            self.count_failure()
+
+    def count_failure(self):
+        if self.metrics is not None:
+            self.metrics.increment("pv_fetch_failures")
+
+    def close(self):
+        for inverter in self.inverters:
+            inverter.close()
@@ -6,13 +6,30 @@ import time
 import signal
 import json
 import logging
-import schedule
-import requests
-
-from pyModbusTCP.client import ModbusClient
+import struct
 
 import asyncio
-from aiomqtt import Client, MqttError
+from types import MappingProxyType
+from aiomqtt import Client, MqttError, Will
+
+from modbus import AsyncModbusClient, CircuitBreaker, WriteCache
+from scheduler import Scheduler, Ticker, OVERRUN_SKIP, OVERRUN_CATCHUP
+from publisher import ChangePublisher, OutboundBuffer
+from pv import PvPoller
+from controller import PowerController, CONTROLLER_MODES, MODE_P, clamp
+from cadence import AdaptiveCadence
+from commands import COMMAND_TOPICS, COMMAND_POWER, COMMAND_GRID_LOADING, COMMAND_EMERGENCY_RESERVE, COMMAND_LIMIT_CHARGING, COMMAND_LIMIT_DISCHARGING, COMMAND_PRIO_CHARGING, CommandQueue
+from metrics import Metrics
+from history import History
+from energy import EnergyCounters
+from aggregator import WindowAggregator
+from snapshot import load_snapshot, save_snapshot
+from cycle import CycleSnapshot, Settings, SnapshotBus
+from tracing import CycleSummary, TraceRing, TRACE_CLAMPED, TRACE_OVERRUN, TRACE_READ_FAILED, TRACE_WRITE_FAILED, describe_flags
+from registers import ADL400_BASE, ADL400_REGISTERS, TIER_CONTROL, TIER_TELEMETRY, TIER_REACTIVE, ReadPlan
+from battery import Battery, BATTERY_MAX_CHARGING, dispatch, parse_battery
+from decoder import RecordDecoder
+from entities import ENTITIES, STATE_ENTITIES, METRIC_ENTITIES, ENERGY_ENTITIES, aggregate_entities, build_discovery, extra_entities, history_entities, history_signals, discovery_digest, scale_digits, load_discovery_hashes, save_discovery_hashes, state_deadbands
 
 logging.basicConfig(
     level=logging.INFO,
@@ -39,25 +56,41 @@ UNIT_ID_ADL = 158                   # Geräteadresse/Slave ID
 
 POWER_FACTOR_TARGET = 1.0
 
+LIMITS_UPDATE_INTERVAL = 180       # Seconds between refreshing the charging/discharging limits
+STATS_REPORT_INTERVAL = 300        # Seconds between logging scheduler jitter statistics
+METRICS_PUBLISH_INTERVAL = 60      # Seconds between publishing the latency metrics to HA
+SNAPSHOT_FILE = "runtime-state.json"
+SNAPSHOT_INTERVAL = 30             # Seconds between storing the runtime state
+SNAPSHOT_MAX_AGE = 600             # Seconds after which the stored setpoint is not used for a warm start
+ENERGY_FILE = "energy.json"
+ENERGY_PUBLISH_INTERVAL = 60       # Seconds between publishing and storing the energy totals
+ENERGY_MAX_GAP = 60.0              # Seconds without readings after which power is not integrated across the gap
+HISTORY_FILE = "history.bin"
+HISTORY_RESOLUTION = 1.0           # Minimum seconds between two recorded samples
+HISTORY_FLUSH_INTERVAL = 60        # Seconds between syncing the history file to disk
+TRACE_DUMP_INTERVAL = 60           # Minimum seconds between two logged traces of the last cycles
+STAGE_RESTART_DELAY = 1.0          # Seconds before a failed publishing or recording stage is restarted
+MODBUS_RETRIES = 3
+MODBUS_RETRY_DELAY = 0.05          # Seconds before the first retry of a Modbus read, doubled for each further retry
+FAILED_CYCLE_PERIOD = 1.0          # Minimum period of cycles without complete readings
+STALE_HOLD = "hold"
+STALE_ZERO = "zero"
+
 REG_SAX_START = 45
-REG_ADL_START = 0x61
+SIGNED_REGISTER = struct.Struct(">h")
 
 mqtt_client = None
-connected_event = asyncio.Event()
 
-client_sax = None
+batteries = []
 client_adl = None
-sax_value = None
-adl_value = None
-pv_value = [0,0,0,0]
-sax_data_event = asyncio.Event() # Set when first data from SAX Battery was received
+adl_plan = None
+pv_poller = None
+sax_data_event = asyncio.Event() # Set when first data from a SAX Battery was received
 adl_data_event = asyncio.Event() # Set when first data from ADL was received
+snapshot_lock = asyncio.Lock()     # Serializes the stores of the runtime state
 cargs = None
-grid_loading = False
-emergency_reserve = 9
-limit_charging = 3500
-limit_discharging = 3500
-prio_charging = 3500
+settings = Settings()
+bus = SnapshotBus()                # Snapshot of the last complete cycle
 
 base_topic = f"{DISCOVERY_PREFIX}/device/{UUID}"
 base_availability_topic = f"{base_topic}/availability"
@@ -68,8 +101,45 @@ base_button_topic = f"{DISCOVERY_PREFIX}/button/{UUID}"
 
 pm_base_topic = f"power-mgr/{UUID}"
 
-counter = 0
-mqtt_lock = False
+DEVICE_DISCOVERY = {
+    "name": NAME,
+    "unique_id": UUID,
+    "command_topic": f"{base_topic}/command",
+    "availability_topic": f"{base_availability_topic}",
+    "json_attributes_topic": f"{base_topic}/attributes",
+    "device": DEVICE,
+    "o": {
+        "name": "power-manager",
+        "sw": SW_VERSION,
+        "url": "https://github.com/"
+    }
+}
+DISCOVERY_HASH_FILE = "discovery-hashes.json"
+HA_STATUS_TOPIC = f"{DISCOVERY_PREFIX}/status"
+MQTT_PENDING_CALLS_THRESHOLD = 200
+MQTT_RECONNECT_DELAY = 1.0         # Seconds before the first reconnect to the broker, doubled for each further attempt
+MQTT_RECONNECT_MAX_DELAY = 60.0
+MQTT_BUFFER_SIZE = 1000            # Topics buffered while the broker is not connected
+
+scheduler = None
+cycle_ticker = None
+state_publisher = None
+write_cache = None
+controller = None
+cadence = None
+commands = CommandQueue()
+outbound = OutboundBuffer(MQTT_BUFFER_SIZE)
+metrics = Metrics()
+history = None
+energy = None
+aggregator = None
+aggregated_entities = ()
+cycle_entities = ()
+discovery_messages = []
+state_entities = STATE_ENTITIES
+trace_ring = None
+cycle_summary = None
+last_flags = 0
 
 def parse_arguments():
     parser = argparse.ArgumentParser(description="Power Manager")
@@ -87,8 +157,24 @@ def parse_arguments():
     )
     parser.add_argument("--host-sax", type=str, required=True, help="Host address of SAX Battery")
     parser.add_argument("--port-sax", type=int, required=True, help="Port of SAX Battery")
+    parser.add_argument("--battery", type=parse_battery, action="append", default=[], help="Additional SAX Battery as host:port[:unit id], can be repeated")
     parser.add_argument("--host-adl", type=str, required=True, help="Host address of ADL400 SmartMeter")
     parser.add_argument("--port-adl", type=int, required=True, help="Port of ADL400 SmartMeter")
+    parser.add_argument("--telemetry-every", type=int, required=False, default=5, help="Number of cycles between two reads of the ADL400 telemetry registers, the total power is read every cycle (default: 5)")
+    parser.add_argument(
+        "--adl-reactive-power",
+        action="store_true",
+        help="Read and publish reactive and apparent power of the ADL400",
+        default=False,
+    )
+    parser.add_argument("--telemetry-window", type=float, required=False, default=0, help="Seconds over which the ADL400 telemetry is aggregated and published as mean, 0 publishes every read (default: 0)")
+    parser.add_argument(
+        "--telemetry-min-max",
+        action="store_true",
+        help="Publish min and max of each telemetry window as additional entities",
+        default=False,
+    )
+    parser.add_argument("--telemetry-precision", type=int, required=False, default=0, help="Decimal places of the window mean in addition to the register resolution (default: 0)")
     parser.add_argument("--host-mqtt", type=str, required=True, help="Host adresse of MQTT Broker")
     parser.add_argument("--port-mqtt", type=int, required=True, help="Port of MQTT Broker")
     parser.add_argument("--user-mqtt", type=str, required=True, help="Username for MQTT Broker")
@@ -96,10 +182,52 @@ def parse_arguments():
     parser.add_argument("--url-pv", type=str, required=True, help="URL for request to PV (only the host part, e.g. http://192.168.1.139)")
     parser.add_argument("--user-pv", type=str, required=True, help="Username for REST request to PV")
     parser.add_argument("--pw-pv", type=str, required=True, help="Password for REST request to PV")
+    parser.add_argument("--inverter", type=str, nargs="+", action="append", default=[], metavar="URL [USER PASSWORD]",
+                        help="Additional PV inverter polled together with --url-pv, without credentials --user-pv/--pw-pv are used, can be repeated")
+    parser.add_argument("--pv-interval", type=float, required=False, default=5, help="Interval in seconds between two requests to PV (default: 5)")
+    parser.add_argument("--pv-timeout", type=float, required=False, default=5, help="Timeout in seconds of the request to each PV inverter (default: 5)")
+    parser.add_argument("--metrics-port", type=int, required=False, default=0, help="Port of the Prometheus metrics endpoint, 0 disables it (default: 0)")
+    parser.add_argument("--history-hours", type=float, required=False, default=48, help="Hours of recorded history kept in the config directory, 0 disables it (default: 48)")
+    parser.add_argument("--config-dir", type=str, required=False, default="/config", help="Directory for persistent data of the add-on (default: /config)")
     parser.add_argument("--log", type=str, required=False, default="INFO", help="Define logging level (INFO, ERROR or DEBUG) (default: INFO)")
-    parser.add_argument("--timeout", type=int, required=False, default=1, help="Timeout after a cycle before a new cycle starts")
+    parser.add_argument("--log-summary-interval", type=float, required=False, default=60, help="Seconds between two logged summaries of the control cycles, 0 logs every cycle (default: 60)")
+    parser.add_argument("--trace-cycles", type=int, required=False, default=120, help="Number of recent control cycles kept in memory and logged on an anomaly, 0 disables it (default: 120)")
+    parser.add_argument("--timeout", type=float, required=False, default=1, help="Period of the control cycle in seconds")
+    parser.add_argument(
+        "--adaptive",
+        action="store_true",
+        help="Adapt the period of the control cycle between --min-interval and --max-interval to the load volatility instead of --timeout",
+        default=False,
+    )
+    parser.add_argument("--min-interval", type=float, required=False, default=0.25, help="Shortest period of the adaptive control cycle in seconds (default: 0.25)")
+    parser.add_argument("--max-interval", type=float, required=False, default=5, help="Longest period of the adaptive control cycle in seconds (default: 5)")
+    parser.add_argument("--volatility-threshold", type=float, required=False, default=200, help="Change of grid power or control error in W between two cycles switching to the shortest period (default: 200)")
+    parser.add_argument("--stale-after", type=float, required=False, default=10, help="Seconds without complete readings after which the stale policy is applied (default: 10)")
+    parser.add_argument("--stale-policy", type=str, required=False, default=STALE_ZERO, choices=[STALE_HOLD, STALE_ZERO], help="Battery target power on stale readings: hold the last value or set it to zero (default: zero)")
+    parser.add_argument("--overrun-policy", type=str, required=False, default=OVERRUN_SKIP, choices=[OVERRUN_SKIP, OVERRUN_CATCHUP], help="Behaviour if a control cycle overruns its period: skip the missed cycles or catch up (default: skip)")
+    parser.add_argument("--controller", type=str, required=False, default=MODE_P, choices=CONTROLLER_MODES, help="Controller for the battery target power (default: P)")
+    parser.add_argument("--kp", type=float, required=False, default=1.0, help="Proportional gain of the controller (default: 1.0)")
+    parser.add_argument("--ki", type=float, required=False, default=0.0, help="Integral gain of the controller in 1/s, used by PI and PID (default: 0.0)")
+    parser.add_argument("--kd", type=float, required=False, default=0.0, help="Derivative gain of the controller in s, used by PID (default: 0.0)")
+    parser.add_argument("--slew-rate", type=float, required=False, default=0, help="Maximum change of the battery target power in W/s, 0 disables the limit (default: 0)")
+    parser.add_argument("--pv-feed-forward", type=float, required=False, default=0.0, help="Gain of the feed-forward of PV power changes, 0 disables it (default: 0.0)")
+    parser.add_argument("--setpoint-tolerance", type=int, required=False, default=0, help="Change of the battery target power in W below which the setpoint is not written again (default: 0)")
+    parser.add_argument("--setpoint-keepalive", type=float, required=False, default=10, help="Seconds after which an unchanged setpoint is written again (default: 10)")
+    parser.add_argument("--limits-keepalive", type=float, required=False, default=900, help="Seconds after which unchanged charging/discharging limits are written again (default: 900)")
     parser.add_argument("--mqtt-update-factor", type=int, required=False, default=1, help="Factor how often an mqtt update is performed")
-    return parser.parse_args()
+    parser.add_argument("--mqtt-max-age", type=float, required=False, default=60, help="Maximum age in seconds after which an unchanged state is published again (default: 60)")
+    parser.add_argument(
+        "--mqtt-json-state",
+        action="store_true",
+        help="Publish the state of each device as one JSON document instead of one topic per value",
+        default=False,
+    )
+    parser.add_argument("--mqtt-deadband-factor", type=float, required=False, default=1.0, help="Factor applied to the deadbands of all state topics, 0 publishes every change (default: 1.0)")
+    args = parser.parse_args()
+    for inverter in args.inverter:
+        if len(inverter) not in (1, 3):
+            parser.error(f"Inverter {' '.join(inverter)} is not given as URL [USER PASSWORD]")
+    return args
 
 def daemonize():
     if os.fork() > 0:
@@ -121,639 +249,623 @@ def signal_handler(signum, frame):
     logging.info("Power Manager is terminated...")
     sys.exit(0)
 
-def fetch_pv_data():
-    global cargs, pv_value
-    try:
-        logging.debug(f"Sending REST request to {cargs.url_pv}/api/dxs.json?dxsEntries=33556736&dxsEntries=67109120&dxsEntries=16780032&dxsEntries=251658754")
-        starttime = time.time()
-        response = requests.get(f"{cargs.url_pv}/api/dxs.json?dxsEntries=33556736&dxsEntries=67109120&dxsEntries=16780032&dxsEntries=251658754", auth=(cargs.user_pv, cargs.pw_pv), timeout=10, verify=True)
-        
-        response.raise_for_status()
-        data = response.json()
-        totaltime = (time.time() - starttime) * 1000
-        logging.debug(f"Received REST response: {response.text}")
-        entries = data.get("dxsEntries", [])
-        if len(entries) == 4:
-            pv_value[0] = entries[0].get("value")
-            pv_value[1] = entries[1].get("value")
-            pv_value[2] = entries[2].get("value")
-            pv_value[3] = entries[3].get("value")
-            logging.info(f"PV data fetching terminated in {totaltime:.3f}ms: DC Power {pv_value[0]}W / AC Power {pv_value[1]}W / State {pv_value[2]}")
-        else:
-            logging.error("REST request failed: Missing entries")
-            pv_value[0] = 0
-            pv_value[1] = 0
-            pv_value[2] = 0
-            pv_value[3] = 0
-
-    except requests.exceptions.RequestException as e:
-        logging.error(f"REST request failed: {e}")
-        pv_value[0] = 0
-        pv_value[1] = 0
-        pv_value[2] = 0
-        pv_value[3] = 0
-
-    return None
-
-
 async def mqtt_task(args):
-    global mqtt_client, client_sax, sax_value, adl_value, grid_loading, emergency_reserve, limit_charging, limit_discharging, prio_charging
-    try:
-        async with Client(
-            hostname=args.host_mqtt,
-            port=args.port_mqtt,
-            username=args.user_mqtt,
-            password=args.pw_mqtt
-        ) as client:
-
-            mqtt_client = client
-            connected_event.set()
-            logging.info("✅ Connected to MQTT Broker.")
-
-            for topic in [
-                    f"{pm_base_topic}/battery/power-cmd", 
-                    f"{pm_base_topic}/battery/grid-loading", 
-                    f"{pm_base_topic}/battery/emergency-power-reserve", 
-                    f"{pm_base_topic}/battery/charging-limit", 
-                    f"{pm_base_topic}/battery/discharging-limit", 
-                    f"{pm_base_topic}/battery/prio-charging"
-                        ]:
-                await client.subscribe(topic)
-                logging.info(f"✅ Subscribed: {topic}")
-        
-            async for message in client.messages:
-                topic = message.topic
-                payload = message.payload.decode()
-                logging.info(f"📩 MQTT Message received {topic}: {payload}")
-            
-                if topic.matches(f"{pm_base_topic}/battery/power-cmd"):
-                    await sax_data_event.wait() # Wait for battery data
-                    if payload == "OFF" and sax_value[0] != 1: # Turn off
-                        logging.info("Turning battery off.")
-                        write_modbus(client_sax, 45, [1])
-                    elif payload == "ON" and sax_value[0] == 1: # Turn on
-                        logging.info("Turning battery on.")
-                        write_modbus(client_sax, 45, [2])
-                    else: 
-                        logging.info("No change for battery power on/off necessary.")
-
-                elif topic.matches(f"{pm_base_topic}/battery/grid-loading"):
-                    if payload == "OFF":
-                        grid_loading = False
-                    else:
-                        grid_loading = True
-
-                    logging.info(f"Turning grid loading {payload}.")
-
-                elif topic.matches(f"{pm_base_topic}/battery/emergency-power-reserve"):
-                    emergency_reserve = int(payload)
-                    logging.info(f"Setting emergency reserve to {payload}%.")
-
-                elif topic.matches(f"{pm_base_topic}/battery/charging-limit"):
-                    limit_charging = int(payload)
-                    logging.info(f"Setting charging limit to {payload}W.")
-                    write_modbus(client_sax, 44, [limit_charging])
-
-                elif topic.matches(f"{pm_base_topic}/battery/discharging-limit"):
-                    limit_discharging = int(payload)
-                    logging.info(f"Setting discharging limit to {payload}W.")
-                    write_modbus(client_sax, 43, [limit_discharging])
-                
-                elif topic.matches(f"{pm_base_topic}/battery/prio-charging"):
-                    prio_charging = int(payload)
-                    logging.info(f"Setting prio charging to {payload}W.")
-
-    except MqttError as error:
-        logging.error(f"❌ MQTT error: {error}")
-
-async def send_mqtt_message(topic, payload, retain=False, overwrite_lock=False):
-    global mqtt_client, mqtt_lock
-    if mqtt_lock and not overwrite_lock:
-        logging.debug("Skipping MQTT update.")
-        return None
+    # Supervises the MQTT session: a lost connection is re-established with increasing delay,
+    # subscriptions are renewed and messages buffered in the meantime are delivered
+    global mqtt_client, commands, metrics
+    command_topics = {f"{pm_base_topic}/{suffix}": command for suffix, command in COMMAND_TOPICS.items()}
+    delay = MQTT_RECONNECT_DELAY
+    reconnect = False
+    while True:
+        try:
+            async with Client(
+                hostname=args.host_mqtt,
+                port=args.port_mqtt,
+                username=args.user_mqtt,
+                password=args.pw_mqtt,
+                will=Will(topic=base_availability_topic, payload="offline")
+            ) as client:
+
+                # Batched publishing has a whole cycle of messages in flight, only warn beyond that
+                client.pending_calls_threshold = MQTT_PENDING_CALLS_THRESHOLD
+                logging.info("✅ Reconnected to MQTT Broker." if reconnect else "✅ Connected to MQTT Broker.")
+
+                for topic in list(command_topics) + [HA_STATUS_TOPIC]:
+                    await client.subscribe(topic)
+                    logging.info(f"✅ Subscribed: {topic}")
+
+                if reconnect:
+                    metrics.increment("mqtt_reconnects")
+                # The control loop does not wait for the broker, its messages were buffered until now
+                await resume_mqtt_session(client)
+                mqtt_client = client
+                delay = MQTT_RECONNECT_DELAY
+                # Only configs not confirmed before are sent, initially or after a lost connection
+                await send_ha_discovery()
+                reconnect = True
+
+                async for message in client.messages:
+                    topic = message.topic
+                    payload = message.payload.decode()
+                    logging.info(f"📩 MQTT Message received {topic}: {payload}")
+
+                    if topic.matches(HA_STATUS_TOPIC):
+                        if payload == "online" and not message.retain:
+                            # HA restarted and may have lost its entities, all configs are sent again
+                            await send_ha_discovery(force=True)
+
+                    elif topic.value in command_topics:
+                        # Applied by the control loop between two cycles, the message loop never waits for devices
+                        commands.put(command_topics[topic.value], payload)
+
+        except MqttError as error:
+            mqtt_client = None
+            logging.error(f"❌ MQTT error: {error}, reconnecting in {delay:.0f}s")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, MQTT_RECONNECT_MAX_DELAY)
+
+async def resume_mqtt_session(client):
+    # Announces availability and delivers the messages buffered while disconnected,
+    # newer messages are buffered until the whole backlog was sent
+    global outbound
+    await client.publish(base_availability_topic, "online")
+    while len(outbound):
+        messages = outbound.take()
+        try:
+            await asyncio.gather(*(client.publish(topic, payload, retain=retain) for topic, (payload, retain) in messages.items()))
+        except MqttError:
+            outbound.restore(messages)
+            raise
+        logging.info(f"Published {len(messages)} buffered MQTT messages.")
+
+async def send_mqtt_message(topic, payload, retain=False):
+    global mqtt_client, outbound, metrics
     if mqtt_client is not None:
-        logging.debug(f"Publishing MQTT: {topic} => {payload}")
-        await mqtt_client.publish(topic, payload, retain=retain)
-    else:
-        logging.error("❌ Unable to send MQTT message. Client not yet connected.")
-
-# HA Discovery
-async def send_ha_discovery():
-    discovery_payload = {
-        "name": NAME,
-        "unique_id": UUID,
-        "command_topic": f"{base_topic}/command",
-        "availability_topic": f"{base_availability_topic}",
-        "json_attributes_topic": f"{base_topic}/attributes",
-        "device": DEVICE,
-        "o": {
-            "name": "power-manager",
-            "sw": SW_VERSION,
-            "url": "https://github.com/"
-        }
-    }
-    discovery_battery_state_sensor = {
-        "name": "Battery Operation Mode",
-        "unique_id": f"{UUID}_pm_battery_state",
-        "icon": "mdi:state-machine",
-        "state_topic": f"{pm_base_topic}/battery/state",
-        "value_template": "{{ value_json }}",
-        "device": DEVICE
-    }
-    discovery_battery_soc_sensor = {
-        "name": "Battery SoC",
-        "unique_id": f"{UUID}_pm_battery_soc",
-        "state_topic": f"{pm_base_topic}/battery/soc",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "%",
-        "device_class": "battery",
-        "device": DEVICE
-    }
-    discovery_battery_power_sensor = {
-        "name": "Battery Power",
-        "unique_id": f"{UUID}_pm_battery_power",
-        "state_topic": f"{pm_base_topic}/battery/power",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "W",
-        "device_class": "power",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_battery_smpower_sensor = {
-        "name": "Battery SmartMeter Power",
-        "unique_id": f"{UUID}_pm_battery_smpower",
-        "state_topic": f"{pm_base_topic}/battery/smpower",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "W",
-        "device_class": "power",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_battery_target_power_sensor = {
-        "name": "Battery Target Power",
-        "unique_id": f"{UUID}_pm_battery_target_power",
-        "state_topic": f"{pm_base_topic}/battery/target_power",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "W",
-        "device_class": "power",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_voltage_a_sensor = {
-        "name": "SmartMeter Voltage Phase A",
-        "unique_id": f"{UUID}_pm_smartmeter_voltage_a",
-        "state_topic": f"{pm_base_topic}/smartmeter/voltage/A",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "V",
-        "device_class": "voltage",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_voltage_b_sensor = {
-        "name": "SmartMeter Voltage Phase B",
-        "unique_id": f"{UUID}_pm_smartmeter_voltage_b",
-        "state_topic": f"{pm_base_topic}/smartmeter/voltage/B",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "V",
-        "device_class": "voltage",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_voltage_c_sensor = {
-        "name": "SmartMeter Voltage Phase C",
-        "unique_id": f"{UUID}_pm_smartmeter_voltage_c",
-        "state_topic": f"{pm_base_topic}/smartmeter/voltage/C",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "V",
-        "device_class": "voltage",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_current_a_sensor = {
-        "name": "SmartMeter Current Phase A",
-        "unique_id": f"{UUID}_pm_smartmeter_current_a",
-        "state_topic": f"{pm_base_topic}/smartmeter/current/A",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "A",
-        "device_class": "current",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_current_b_sensor = {
-        "name": "SmartMeter Current Phase B",
-        "unique_id": f"{UUID}_pm_smartmeter_current_b",
-        "state_topic": f"{pm_base_topic}/smartmeter/current/B",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "A",
-        "device_class": "current",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_current_c_sensor = {
-        "name": "SmartMeter Current Phase C",
-        "unique_id": f"{UUID}_pm_smartmeter_current_c",
-        "state_topic": f"{pm_base_topic}/smartmeter/current/C",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "A",
-        "device_class": "current",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_actpower_a_sensor = {
-        "name": "SmartMeter Active Power Phase A",
-        "unique_id": f"{UUID}_pm_smartmeter_actpower_a",
-        "state_topic": f"{pm_base_topic}/smartmeter/power/active/A",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "W",
-        "device_class": "power",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_actpower_b_sensor = {
-        "name": "SmartMeter Active Power Phase B",
-        "unique_id": f"{UUID}_pm_smartmeter_actpower_b",
-        "state_topic": f"{pm_base_topic}/smartmeter/power/active/B",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "W",
-        "device_class": "power",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_actpower_c_sensor = {
-        "name": "SmartMeter Active Power Phase C",
-        "unique_id": f"{UUID}_pm_smartmeter_actpower_c",
-        "state_topic": f"{pm_base_topic}/smartmeter/power/active/C",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "W",
-        "device_class": "power",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_actpower_total_sensor = {
-        "name": "SmartMeter Active Power Total",
-        "unique_id": f"{UUID}_pm_smartmeter_actpower_total",
-        "state_topic": f"{pm_base_topic}/smartmeter/power/active/total",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "W",
-        "device_class": "power",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_powerfactor_a_sensor = {
-        "name": "SmartMeter Power Factor Phase A",
-        "unique_id": f"{UUID}_pm_smartmeter_power_factor_a",
-        "state_topic": f"{pm_base_topic}/smartmeter/power-factor/A",
-        "value_template": "{{ value_json }}",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_powerfactor_b_sensor = {
-        "name": "SmartMeter Power Factor Phase B",
-        "unique_id": f"{UUID}_pm_smartmeter_power_factor_b",
-        "state_topic": f"{pm_base_topic}/smartmeter/power-factor/B",
-        "value_template": "{{ value_json }}",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_powerfactor_c_sensor = {
-        "name": "SmartMeter Power Factor Phase C",
-        "unique_id": f"{UUID}_pm_smartmeter_power_factor_c",
-        "state_topic": f"{pm_base_topic}/smartmeter/power-factor/C",
-        "value_template": "{{ value_json }}",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_powerfactor_total_sensor = {
-        "name": "SmartMeter Power Factor Total",
-        "unique_id": f"{UUID}_pm_smartmeter_power_factor_total",
-        "state_topic": f"{pm_base_topic}/smartmeter/power-factor/total",
-        "value_template": "{{ value_json }}",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_smartmeter_frequency_sensor = {
-        "name": "SmartMeter Frequency",
-        "unique_id": f"{UUID}_pm_smartmeter_frequency",
-        "state_topic": f"{pm_base_topic}/smartmeter/frequency",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "Hz",
-        "device_class": "frequency",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_pv_state_sensor = {
-        "name": "PV Operation Mode",
-        "unique_id": f"{UUID}_pm_pv_state",
-        "icon": "mdi:state-machine",
-        "state_topic": f"{pm_base_topic}/pv/state",
-        "value_template": "{{ value_json }}",
-        "device": DEVICE
-    }
-    discovery_pv_power_sensor = {
-        "name": "PV Power",
-        "unique_id": f"{UUID}_pm_pv_power",
-        "state_topic": f"{pm_base_topic}/pv/power/total",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "W",
-        "device_class": "power",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_pv_dc_power_sensor = {
-        "name": "PV DC Power",
-        "unique_id": f"{UUID}_pm_pv_dc_power",
-        "state_topic": f"{pm_base_topic}/pv/power/dc_in",
-        "value_template": "{{ value_json }}",
-        "unit_of_measurement": "W",
-        "device_class": "power",
-        "state_class": "measurement",
-        "device": DEVICE
-    }
-    discovery_pv_day_yield_sensor = {
-        "name": "PV Day Yield",
-        "unique_id": f"{UUID}_pm_pv_day_yield",
-        "state_topic": f"{pm_base_topic}/pv/day_yield",
-        "value_template": "{{ (value_json | float) / 1000 | round(1) }}",
-        "unit_of_measurement": "kWh",
-        "device_class": "energy",
-        "state_class": "total_increasing",
-        "device": DEVICE
-    }
-    discovery_battery_power_on_button = {
-        "name": "Battery Power On",
-        "unique_id": f"{UUID}_pm_battery_power_on",
-        "command_topic": f"{pm_base_topic}/battery/power-cmd",
-        "payload_press": "ON",
-        "icon": "mdi:power-on",
-        "device": DEVICE
-    }
-    discovery_battery_power_off_button = {
-        "name": "Battery Power Off",
-        "unique_id": f"{UUID}_pm_battery_power_off",
-        "command_topic": f"{pm_base_topic}/battery/power-cmd",
-        "payload_press": "OFF",
-        "icon": "mdi:power-off",
-        "device": DEVICE
-    }
-    discovery_battery_grid_loading_switch = {
-        "name": "Battery Grid Loading",
-        "unique_id": f"{UUID}_pm_battery_grid_loading_switch",
-        "command_topic": f"{pm_base_topic}/battery/grid-loading",
-        "qos": 1,
-        "retain": True,
-        "device_class": "switch",
-        "device": DEVICE
-    }
-    discovery_battery_emergency_reserve_number = {
-        "name": "Emergency Power Reserve",
-        "unique_id": f"{UUID}_pm_emergency_power_reserve_number",
-        "command_topic": f"{pm_base_topic}/battery/emergency-power-reserve",
-        "qos": 1,
-        "retain": True,
-        "unit_of_measurement": "%",
-        "min": "0",
-        "max": "90",
-        "mode": "slider",
-        "device": DEVICE
-    }
-    discovery_battery_limit_charging_number = {
-        "name": "Charging limit",
-        "unique_id": f"{UUID}_pm_charging_limit_number",
-        "command_topic": f"{pm_base_topic}/battery/charging-limit",
-        "qos": 1,
-        "retain": True,
-        "unit_of_measurement": "W",
-        "min": 0,
-        "max": 3500,
-        "mode": "slider",
-        "step": 50,
-        "device_class": "power",
-        "device": DEVICE
-    }
-    discovery_battery_limit_discharging_number = {
-        "name": "Discharging limit",
-        "unique_id": f"{UUID}_pm_discharging_limit_number",
-        "command_topic": f"{pm_base_topic}/battery/discharging-limit",
-        "qos": 1,
-        "retain": True,
-        "unit_of_measurement": "W",
-        "min": 0,
-        "max": 4600,
-        "mode": "slider",
-        "step": 50,
-        "device_class": "power",
-        "device": DEVICE
-    }
-    discovery_battery_prio_charging_number = {
-        "name": "Prioritized charging power",
-        "unique_id": f"{UUID}_pm_prio_charging_number",
-        "command_topic": f"{pm_base_topic}/battery/prio-charging",
-        "qos": 1,
-        "retain": True,
-        "unit_of_measurement": "W",
-        "min": 0,
-        "max": 3500,
-        "mode": "slider",
-        "step": 50,
-        "device_class": "power",
-        "device": DEVICE
-    }
-    await send_mqtt_message(topic=f"{base_topic}/config", payload=json.dumps(discovery_payload), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/battery_state/config", payload=json.dumps(discovery_battery_state_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/battery_soc/config", payload=json.dumps(discovery_battery_soc_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/battery_power/config", payload=json.dumps(discovery_battery_power_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/battery_smpower/config", payload=json.dumps(discovery_battery_smpower_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/battery_target_power/config", payload=json.dumps(discovery_battery_target_power_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_voltage_a/config", payload=json.dumps(discovery_smartmeter_voltage_a_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_voltage_b/config", payload=json.dumps(discovery_smartmeter_voltage_b_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_voltage_c/config", payload=json.dumps(discovery_smartmeter_voltage_c_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_current_a/config", payload=json.dumps(discovery_smartmeter_current_a_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_current_b/config", payload=json.dumps(discovery_smartmeter_current_b_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_current_c/config", payload=json.dumps(discovery_smartmeter_current_c_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_actpower_a/config", payload=json.dumps(discovery_smartmeter_actpower_a_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_actpower_b/config", payload=json.dumps(discovery_smartmeter_actpower_b_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_actpower_c/config", payload=json.dumps(discovery_smartmeter_actpower_c_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_actpower_total/config", payload=json.dumps(discovery_smartmeter_actpower_total_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_power_factor_a/config", payload=json.dumps(discovery_smartmeter_powerfactor_a_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_power_factor_b/config", payload=json.dumps(discovery_smartmeter_powerfactor_b_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_power_factor_c/config", payload=json.dumps(discovery_smartmeter_powerfactor_c_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_power_factor_total/config", payload=json.dumps(discovery_smartmeter_powerfactor_total_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/smartmeter_frequency/config", payload=json.dumps(discovery_smartmeter_frequency_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/pv_state/config", payload=json.dumps(discovery_pv_state_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/pv_power/config", payload=json.dumps(discovery_pv_power_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/pv_dc_power/config", payload=json.dumps(discovery_pv_dc_power_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_sensor_topic}/pv_day_yield/config", payload=json.dumps(discovery_pv_day_yield_sensor), retain=True)
-    await send_mqtt_message(topic=f"{base_button_topic}/battery_power_on/config", payload=json.dumps(discovery_battery_power_on_button), retain=True)
-    await send_mqtt_message(topic=f"{base_button_topic}/battery_power_off/config", payload=json.dumps(discovery_battery_power_off_button), retain=True)
-    await send_mqtt_message(topic=f"{base_switch_topic}/battery_grid/config", payload=json.dumps(discovery_battery_grid_loading_switch), retain=True)
-    await send_mqtt_message(topic=f"{base_number_topic}/emergency_power_reserve/config", payload=json.dumps(discovery_battery_emergency_reserve_number), retain=True)
-    await send_mqtt_message(topic=f"{base_number_topic}/limit_charging/config", payload=json.dumps(discovery_battery_limit_charging_number), retain=True)
-    await send_mqtt_message(topic=f"{base_number_topic}/limit_discharging/config", payload=json.dumps(discovery_battery_limit_discharging_number), retain=True)
-    await send_mqtt_message(topic=f"{base_number_topic}/prio_charging/config", payload=json.dumps(discovery_battery_prio_charging_number), retain=True)
-
-def unsigned_to_signed(unsigned_value, bits=16):
-    max_unsigned = 2 ** bits
-    max_signed = 2 ** (bits - 1)
-    return unsigned_value if unsigned_value < max_signed else unsigned_value - max_unsigned
-
-def fetch_modbus(client, start, length):
-    for _ in range(5):
-        result = client.read_holding_registers(start, length)
+        logging.debug("Publishing MQTT: %s => %s", topic, payload)
+        try:
+            await mqtt_client.publish(topic, payload, retain=retain)
+            return True
+        except MqttError as error:
+            logging.debug("Publishing MQTT %s failed: %s", topic, error)
+    # Only the latest message per topic is kept until the session is re-established
+    logging.debug("MQTT not connected, buffering: %s => %s", topic, payload)
+    if outbound.put(topic, payload, retain):
+        metrics.increment("mqtt_dropped")
+    return False
+
+async def send_ha_discovery(force=False):
+    global cargs, discovery_messages
+    hash_file = os.path.join(cargs.config_dir, DISCOVERY_HASH_FILE)
+    hashes = {} if force else load_discovery_hashes(hash_file)
+    digests = {topic: discovery_digest(payload) for topic, payload in discovery_messages}
+    # Configs already retained on the broker with identical content are not published again
+    pending = [(topic, payload) for topic, payload in discovery_messages if hashes.get(topic) != digests[topic]]
+    results = await asyncio.gather(*(send_mqtt_message(topic=topic, payload=payload, retain=True) for topic, payload in pending))
+    logging.info(f"Published {sum(results)} HA discovery configs, {len(discovery_messages) - len(pending)} unchanged.")
+    if all(results):
+        save_discovery_hashes(hash_file, digests)
+
+async def fetch_modbus(client, start, length, stage=None):
+    # Register data as bytes, decoded by the compiled decoders without converting it to a list first
+    global metrics
+    attempt = 0
+    while True:
+        result = await client.read_holding_register_bytes(start, length)
         if result is not None:
+            if attempt and stage is not None:
+                metrics.increment(f"{stage}_retries", attempt)
             return result
-    
+        if attempt + 1 >= MODBUS_RETRIES or not client.available:
+            break
+        # Retries back off a little, an open circuit breaker ends them
+        await asyncio.sleep(MODBUS_RETRY_DELAY * 2 ** attempt)
+        attempt += 1
+
+    if stage is not None:
+        metrics.increment(f"{stage}_retries", attempt)
+        metrics.increment(f"{stage}_failures")
     return None
 
-def write_modbus(client, register, values):
-    global cargs
+async def timed_fetch_modbus(client, start, length, stage):
+    global metrics
+    starttime = time.time()
+    result = await fetch_modbus(client, start, length, stage)
+    totaltime = (time.time() - starttime) * 1000
+    metrics.observe(stage, totaltime)
+    return result, totaltime
+
+async def timed_fetch_plan(client, plan, block, stage):
+    # Reads the requests of the next cycle of the plan into block, None if a request failed
+    global metrics
+    starttime = time.time()
+    result = block
+    for offset, count in plan.next():
+        values = await fetch_modbus(client, plan.base + offset, count, stage)
+        if values is None:
+            result = None
+            break
+        block[2 * offset:2 * (offset + count)] = values
+    else:
+        plan.done()
+    totaltime = (time.time() - starttime) * 1000
+    metrics.observe(stage, totaltime)
+    return result, totaltime
+
+async def write_modbus(client, register, values, tolerance=0, keepalive=None, force=False, stage=None):
+    global cargs, write_cache, metrics
+    key = (client.host, client.port, client.unit_id, register)
+    now = time.monotonic()
+    if not force and not write_cache.is_due(key, values, now, tolerance, keepalive):
+        write_cache.suppressed += 1
+        logging.debug("Writing modbus suppressed, unchanged: Register - %s / %s", register, values)
+        return None
     if cargs.sim:
-        logging.info("Writing modbus skipped.")
+        logging.debug("Writing modbus skipped.")
+        write_cache.mark_written(key, values, now)
         return None
     starttime = time.time()
-    result = client.write_multiple_registers(register, values)
+    result = await client.write_multiple_registers(register, values)
     endtime = time.time()
-    totaltime = endtime - starttime
-    logging.info(f"Writing modbus in {totaltime:.3f}ms: Register - {register} / {values}")
-    #SAX liefert immer falsche Transaction ID zurück
-    #if result:
-    #    print("Erfolgreich geschrieben")
-    #else:
-    #    print("Schreiben fehlgeschlagen.")
+    totaltime = (endtime - starttime) * 1000
+    logging.debug("Writing modbus in %.3fms: Register - %s / %s", totaltime, register, values)
+    if stage is not None:
+        metrics.observe(stage, totaltime)
+    if result:
+        write_cache.mark_written(key, values, now)
+    else:
+        write_cache.invalidate(key)
+        if stage is not None:
+            metrics.increment(f"{stage}_failures")
     return result
 
-def update_limits():
-    global client_sax
+async def update_limits():
+    global batteries, settings, cargs
     logging.info("Updating limits ...")
-    write_modbus(client_sax, 43, [limit_discharging])
-    write_modbus(client_sax, 44, [limit_charging])
+    # Discharging (43) and charging limit (44) are written in one request
+    await asyncio.gather(*(write_modbus(battery.client, 43, [settings.limit_discharging, settings.limit_charging], keepalive=cargs.limits_keepalive) for battery in batteries))
+
+def runtime_state():
+    global settings, bus
+    latest = bus.latest
+    return {
+        "settings": settings._asdict(),
+        "setpoint": None if latest is None else latest.target,
+        "readings": {
+            "grid_power": None if latest is None else latest.grid_power,
+            "batteries": [] if latest is None else [{"power": power, "soc": soc} for power, soc in zip(latest.powers, latest.socs)],
+        },
+    }
+
+def restore_runtime_state(snapshot):
+    # Settings of the last run are used until the retained command topics arrive,
+    # returns the last setpoint if the snapshot is recent enough to continue from it
+    global settings
+    try:
+        stored = snapshot["settings"]
+        restored = Settings(grid_loading=bool(stored["grid_loading"]), emergency_reserve=int(stored["emergency_reserve"]),
+                            limit_charging=int(stored["limit_charging"]), limit_discharging=int(stored["limit_discharging"]),
+                            prio_charging=int(stored["prio_charging"]))
+        age = time.time() - float(snapshot["time"])
+        setpoint = snapshot.get("setpoint")
+    except (KeyError, TypeError, ValueError) as e:
+        logging.error(f"❌ Runtime state is incomplete, starting with defaults: {e}")
+        return None
+    settings = restored
+    logging.info(f"✅ Warm start from runtime state of {age:.0f}s ago: Grid loading {'ON' if settings.grid_loading else 'OFF'} / Emergency reserve {settings.emergency_reserve}% / "
+                 f"Charging limit {settings.limit_charging}W / Discharging limit {settings.limit_discharging}W / Prio charging {settings.prio_charging}W / Setpoint {setpoint}W")
+    if not isinstance(setpoint, int) or not 0 <= age <= SNAPSHOT_MAX_AGE:
+        return None
+    return setpoint
+
+async def save_runtime_state():
+    # The state is taken on the event loop, the blocking write and fsync run in a worker thread.
+    # The lock keeps a save of changed settings and the periodic save from sharing the temporary file.
+    global cargs
+    state = runtime_state()
+    async with snapshot_lock:
+        await asyncio.to_thread(save_snapshot, os.path.join(cargs.config_dir, SNAPSHOT_FILE), state)
+
+async def apply_commands():
+    # Changed settings take effect as a new Settings instance with the next cycle
+    global commands, batteries, settings
+    pending = commands.take()
+    writes = []
+    changes = {}
+    for command, payload in pending.items():
+        try:
+            if command == COMMAND_POWER:
+                if not sax_data_event.is_set():
+                    commands.put(command, payload)  # Battery mode unknown yet, applied after the first reading
+                    continue
+                for battery in batteries:
+                    if battery.value is None:
+                        logging.warning(f"{battery.name} has not answered yet, power {payload} skipped for it.")
+                    elif payload == "OFF" and battery.mode != 1: # Turn off
+                        logging.info(f"Turning {battery.name} off.")
+                        writes.append(write_modbus(battery.client, 45, [1], force=True))
+                    elif payload == "ON" and battery.mode == 1: # Turn on
+                        logging.info(f"Turning {battery.name} on.")
+                        writes.append(write_modbus(battery.client, 45, [2], force=True))
+                    else: 
+                        logging.info(f"No change for {battery.name} power on/off necessary.")
+            elif command == COMMAND_GRID_LOADING:
+                changes["grid_loading"] = payload != "OFF"
+                logging.info(f"Turning grid loading {payload}.")
+            elif command == COMMAND_EMERGENCY_RESERVE:
+                changes["emergency_reserve"] = int(payload)
+                logging.info(f"Setting emergency reserve to {payload}%.")
+            elif command == COMMAND_LIMIT_CHARGING:
+                changes["limit_charging"] = int(payload)
+                logging.info(f"Setting charging limit to {payload}W.")
+            elif command == COMMAND_LIMIT_DISCHARGING:
+                changes["limit_discharging"] = int(payload)
+                logging.info(f"Setting discharging limit to {payload}W.")
+            elif command == COMMAND_PRIO_CHARGING:
+                changes["prio_charging"] = int(payload)
+                logging.info(f"Setting prio charging to {payload}W.")
+        except ValueError:
+            logging.error(f"❌ Invalid payload for {command}: {payload}")
+    if changes:
+        settings = settings._replace(**changes)
+    if COMMAND_LIMIT_CHARGING in pending or COMMAND_LIMIT_DISCHARGING in pending:
+        writes.extend(write_modbus(battery.client, 43, [settings.limit_discharging, settings.limit_charging]) for battery in batteries)
+    await asyncio.gather(*writes)
+    if pending.keys() - {COMMAND_POWER}:
+        # Changed settings are stored at once, they must survive a restart
+        await save_runtime_state()
+
+async def report_scheduler_stats():
+    global scheduler, cycle_ticker, state_publisher, write_cache, commands, history
+    logging.info(f"Control cycle: {cycle_ticker.stats.summary()} / {state_publisher.suppressed} unchanged MQTT updates suppressed / {write_cache.suppressed} unchanged Modbus writes suppressed / {commands.coalesced} commands coalesced")
+    if history is not None:
+        grid = history.stats("smartmeter_actpower_total", STATS_REPORT_INTERVAL, time.time())
+        if grid is not None:
+            logging.info(f"Grid power of the last {STATS_REPORT_INTERVAL}s: min {grid[0]:.0f}W / mean {grid[1]:.0f}W / max {grid[2]:.0f}W")
+    cycle_ticker.stats.reset()
+    state_publisher.suppressed = 0
+    write_cache.suppressed = 0
+    commands.coalesced = 0
+    for name, ticker in scheduler.jobs.items():
+        if ticker.stats.overruns:
+            logging.info(f"Job {name}: {ticker.stats.summary()}")
+
+async def publish_metrics():
+    global state_publisher, metrics
+    values = metrics.values()
+    for entity in METRIC_ENTITIES:
+        if entity.index in values:
+            state_publisher.queue(topic=f"{pm_base_topic}/{entity.topic}", payload=values[entity.index], retain=True)
+    await state_publisher.flush()
+
+def connection_states():
+    global batteries, client_adl
+    states = {f"sax_link{battery.suffix}": battery.client.breaker.state for battery in batteries}
+    states["adl_link"] = client_adl.breaker.state
+    return states
+
+async def publish_connection_states():
+    # Published on cycles without complete readings. In JSON mode the link states are merged into the
+    # retained device documents, the last readings stay in them during the outage.
+    global state_publisher, state_entities
+    states = connection_states()
+    for entity in state_entities:
+        if entity.source == "calc" and entity.index in states:
+            state_publisher.queue(topic=f"{pm_base_topic}/{entity.topic}", payload=states[entity.index], retain=True)
+    await state_publisher.flush()
+
+async def publish_energy():
+    global state_publisher, energy
+    values = energy.values()
+    for entity in ENERGY_ENTITIES:
+        state_publisher.queue(topic=f"{pm_base_topic}/{entity.topic}", payload=values[entity.index], retain=True)
+    await state_publisher.flush()
+    energy.save()
+
+def queue_aggregates(aggregates):
+    global state_publisher, aggregated_entities, cargs
+    for entity in aggregated_entities:
+        if entity.topic not in aggregates:
+            continue
+        mean, lowest, highest = aggregates[entity.topic]
+        state_publisher.queue(topic=f"{pm_base_topic}/{entity.topic}", payload=round(mean, scale_digits(entity.scale) + cargs.telemetry_precision), retain=True)
+        if cargs.telemetry_min_max:
+            state_publisher.queue(topic=f"{pm_base_topic}/{entity.topic}/min", payload=lowest, retain=True)
+            state_publisher.queue(topic=f"{pm_base_topic}/{entity.topic}/max", payload=highest, retain=True)
+
+async def flush_history():
+    global history
+    history.flush()
+
+async def publish_cycles(subscription):
+    # Publishes the states of every mqtt_update_factor-th cycle snapshot, a publish taking longer than
+    # the cycle skips snapshots without delaying the control loop
+    global cargs, batteries, state_publisher, cycle_entities, aggregated_entities, aggregator, metrics
+    sources = [battery.source for battery in batteries]
+    # Decoders are compiled once, each snapshot is decoded in one pass per register block
+    states = RecordDecoder(cycle_entities, ["adl", *sources])
+    aggregates = RecordDecoder(aggregated_entities, ["adl"]) if aggregator is not None else None
+    async for snapshot in subscription:
+        if aggregates is not None:
+            # Only registers read in this cycle are aggregated, the others still hold older values
+            for entity, value in zip(aggregated_entities, aggregates.decode({"adl": snapshot.adl})):
+                if entity.index in snapshot.fresh:
+                    aggregator.add(entity.topic, value, snapshot.time)
+        if snapshot.number % cargs.mqtt_update_factor:
+            continue
+        starttime = time.time()
+        await send_mqtt_message(topic=f"{base_availability_topic}", payload="online", retain=False)
+        for entity, value in zip(cycle_entities, states.decode(snapshot.blocks(sources))):
+            if value is not None:
+                state_publisher.queue(topic=f"{pm_base_topic}/{entity.topic}", payload=value, retain=True)
+        if aggregator is not None and aggregator.due(snapshot.time):
+            queue_aggregates(aggregator.collect(snapshot.time))
+        await state_publisher.flush()
+        totaltime = (time.time() - starttime) * 1000
+        metrics.observe("mqtt_publish", totaltime)
+        logging.debug("MQTT update of cycle %d in %.3fms done.", snapshot.number, totaltime)
+
+async def record_cycles(subscription, recorded_entities):
+    # Integrates the energy totals and records the history from the cycle snapshots
+    global cargs, batteries, energy, history
+    sources = [battery.source for battery in batteries]
+    resolution = max(cargs.timeout, HISTORY_RESOLUTION)
+    recorded = RecordDecoder(recorded_entities, ["adl", *sources])
+    async for snapshot in subscription:
+        energy.update(snapshot.time, snapshot.grid_power, snapshot.batteries_power)
+        if history is not None and (history.last_time is None or snapshot.timestamp - history.last_time >= resolution):
+            blocks = snapshot.blocks(sources)
+            blocks["pv"] = None if snapshot.pv_stale else snapshot.pv
+            history.append(snapshot.timestamp, recorded.decode(blocks))
+
+def start_stage(stages, stage, subscription, *arguments):
+    # Runs a consumer of the cycle snapshots as task in stages. A stage ending with an exception is
+    # logged and restarted on the same subscription after STAGE_RESTART_DELAY seconds.
+    task = asyncio.create_task(stage(subscription, *arguments))
+    stages.append(task)
+
+    def restart(task):
+        stages.remove(task)
+        if task.cancelled():
+            return
+        logging.error(f"❌ Stage {stage.__name__} failed, restarting in {STAGE_RESTART_DELAY:.0f}s: {task.exception()!r}")
+        asyncio.get_running_loop().call_later(STAGE_RESTART_DELAY, start_stage, stages, stage, subscription, *arguments)
+
+    task.add_done_callback(restart)
+
+def trace_cycle(sax_time, adl_time, cycle_time, grid_power, battery_power, target, lower, upper, flags):
+    # Records the cycle in the trace ring, the ring is logged when an anomaly starts
+    global trace_ring, cycle_summary, last_flags
+    trace_ring.record(sax_time, adl_time, cycle_time, grid_power, battery_power, target, lower, upper, flags)
+    cycle_summary.add(cycle_time, flags & TRACE_READ_FAILED)
+    # Overruns are single events, failed readings and clamping are states only reported when entered
+    anomalies = flags & (TRACE_OVERRUN | ~last_flags)
+    last_flags = flags
+    if anomalies:
+        trace_ring.dump(f"Control cycle anomaly ({describe_flags(anomalies)})", anomalies)
+    now = time.monotonic()
+    if cycle_summary.due(now):
+        cycle_summary.log(now, target)
 
 async def main(args):
-    global client_sax, client_adl, sax_value, adl_value, grid_loading, emergency_reserve, limit_charging, limit_discharging, prio_charging, cargs, counter, mqtt_lock
+    started = time.monotonic()
+    global batteries, client_adl, adl_plan, settings, bus, cargs, scheduler, cycle_ticker, state_publisher, pv_poller, discovery_messages, state_entities, write_cache, controller, cadence, history, energy, aggregator, aggregated_entities, cycle_entities, trace_ring, cycle_summary
     logging.info("Starting Power Manager ...")
     signal.signal(signal.SIGTERM, signal_handler)  # Beenden bei SIGTERM
 
     cargs = args
+    scheduler = Scheduler()
+    cycle_ticker = Ticker(args.timeout, args.overrun_policy)
+    if args.adaptive:
+        cadence = AdaptiveCadence(args.min_interval, args.max_interval, args.volatility_threshold)
+        cycle_ticker.interval = cadence.interval
+    metrics_server = None
+    stages = []
+    write_cache = WriteCache(keepalive=args.setpoint_keepalive)
+    trace_ring = TraceRing(args.trace_cycles, TRACE_DUMP_INTERVAL)
+    cycle_summary = CycleSummary(args.log_summary_interval)
+    controller = PowerController(args.controller, args.kp, args.ki, args.kd, args.slew_rate, args.pv_feed_forward)
+    inverters = [(args.url_pv, args.user_pv, args.pw_pv)] + [(url, *(credentials or (args.user_pv, args.pw_pv))) for url, *credentials in args.inverter]
+    pv_poller = PvPoller(inverters, args.pv_interval, args.pv_timeout, metrics=metrics)
+    batteries = [Battery(1, args.host_sax, args.port_sax, UNIT_ID_SAX)] + [
+        Battery(number, host, port, UNIT_ID_SAX if unit_id is None else unit_id) for number, (host, port, unit_id) in enumerate(args.battery, start=2)]
+    extra = extra_entities(len(batteries), args.adl_reactive_power)
+    # Only the total power is needed by the control law, the telemetry registers are read less often
+    adl_plan = ReadPlan(ADL400_BASE, ADL400_REGISTERS, {TIER_CONTROL: 1, TIER_TELEMETRY: args.telemetry_every,
+                                                        TIER_REACTIVE: args.telemetry_every if args.adl_reactive_power else None})
+    adl_block = bytearray(2 * adl_plan.length)
+    state_entities = STATE_ENTITIES + extra
+    cycle_entities = state_entities
+    if args.telemetry_window > 0:
+        # Telemetry is published once per window, the control related values every cycle
+        telemetry_offsets = {register.offset for register in ADL400_REGISTERS if register.tier != TIER_CONTROL}
+        aggregated_entities = tuple(entity for entity in state_entities if entity.source == "adl" and entity.index in telemetry_offsets)
+        cycle_entities = tuple(entity for entity in state_entities if entity not in aggregated_entities)
+        aggregator = WindowAggregator(args.telemetry_window)
+        if args.telemetry_min_max:
+            extra += aggregate_entities(aggregated_entities)
+    discovery_messages = [(f"{base_topic}/config", json.dumps(DEVICE_DISCOVERY))] + build_discovery(UUID, DEVICE, DISCOVERY_PREFIX, pm_base_topic, args.mqtt_json_state,
+                                                                                                    ENTITIES + extra + ENERGY_ENTITIES + METRIC_ENTITIES)
+    state_publisher = ChangePublisher(send_mqtt_message, state_deadbands(pm_base_topic, state_entities), max_age=args.mqtt_max_age, deadband_factor=args.mqtt_deadband_factor,
+                                      json_base_topic=pm_base_topic if args.mqtt_json_state else None)
+    energy = EnergyCounters(os.path.join(args.config_dir, ENERGY_FILE), ENERGY_MAX_GAP)
+    if args.history_hours > 0:
+        history_path = os.path.join(args.config_dir, HISTORY_FILE)
+        try:
+            history = History(history_path, history_signals(state_entities), int(args.history_hours * 3600 / max(args.timeout, HISTORY_RESOLUTION)))
+        except (OSError, ValueError) as e:
+            logging.error(f"❌ Unable to open history {history_path}: {e}")
 
     try:
-        client_sax = ModbusClient(host=args.host_sax, port=args.port_sax, unit_id=UNIT_ID_SAX)
-        client_adl = ModbusClient(host=args.host_adl, port=args.port_adl, unit_id=UNIT_ID_ADL)
-        if client_sax.open():
-            logging.info("✅ Connected to SAX Battery.")
-        else:
-            logging.error("❌ Connecting to SAX Battery failed.")
+        client_adl = AsyncModbusClient(host=args.host_adl, port=args.port_adl, unit_id=UNIT_ID_ADL, breaker=CircuitBreaker("ADL400"))
+        *sax_open, adl_open = await asyncio.gather(*(battery.client.open() for battery in batteries), client_adl.open())
+        for battery, opened in zip(batteries, sax_open):
+            if opened:
+                logging.info(f"✅ Connected to {battery.name}.")
+            else:
+                logging.error(f"❌ Connecting to {battery.name} failed.")
 
-        if client_adl.open():
+        if adl_open:
             logging.info("✅ Connected to ADL400.")
         else:
             logging.error("❌ Connecting to ADL400 failed.")
 
-        task = asyncio.create_task(mqtt_task(args))
-        await connected_event.wait() # Wait until mqtt is connected
-
-        await send_ha_discovery()
-
-        schedule.every(3).minutes.do(update_limits)
+        scheduler.every(args.pv_interval, pv_poller.poll, name="pv", run_immediately=True)
 
+        # MQTT and HA discovery come up in parallel, the control loop starts at once with the stored settings
+        task = asyncio.create_task(mqtt_task(args))
+        snapshot = load_snapshot(os.path.join(args.config_dir, SNAPSHOT_FILE))
+        setpoint = restore_runtime_state(snapshot) if snapshot is not None else None
+
+        scheduler.every(LIMITS_UPDATE_INTERVAL, update_limits, run_immediately=True)
+        scheduler.every(SNAPSHOT_INTERVAL, save_runtime_state)
+        scheduler.every(STATS_REPORT_INTERVAL, report_scheduler_stats)
+        scheduler.every(METRICS_PUBLISH_INTERVAL, publish_metrics)
+        scheduler.every(ENERGY_PUBLISH_INTERVAL, publish_energy, run_immediately=True)
+        if history is not None:
+            scheduler.every(HISTORY_FLUSH_INTERVAL, flush_history)
+        if args.metrics_port:
+            metrics_server = await metrics.serve(args.metrics_port)
+
+        # Publishing and recording follow the snapshots of the control loop in their own tasks
+        start_stage(stages, publish_cycles, bus.subscribe())
+        start_stage(stages, record_cycles, bus.subscribe(), history_entities(state_entities))
+        number = 0
+        last_complete_read = time.monotonic()
+        failsafe = False
+        sax_target_value = 0
+        held_targets = []                 # (battery, target) of the last setpoint writes
+        if setpoint is not None:
+            # Failsafe hold and slew rate continue from the last setpoint instead of 0W
+            sax_target_value = setpoint
+            controller.hold(setpoint)
+        first_setpoint = True
         while True:
-            counter = (counter + 1) % args.mqtt_update_factor
-            if counter == 0:
-                mqtt_lock = False
-            else:
-                mqtt_lock = True
-
-            await send_mqtt_message(topic=f"{base_availability_topic}", payload="online", retain=False)
+            overruns = cycle_ticker.stats.overruns
+            await cycle_ticker.tick()
+            flags = TRACE_OVERRUN if cycle_ticker.stats.overruns != overruns else 0
+            await apply_commands()
+            current = settings
 
             starttime_a = time.time()
-            sax_value = fetch_modbus(client_sax, REG_SAX_START, 4)
-            totaltime_sax = (time.time() - starttime_a) * 1000
-            if sax_value is None:
-                logging.error("No response could be retrieved by SAX Battery. Retrying full cycle.")
-                continue
-            sax_power = sax_value[2] - 16384
-            sax_smpower = sax_value[3] - 16384
-            sax_data_event.set()
-            logging.debug(f"SAX Battery response in {totaltime_sax:.3f}ms: Mode {sax_value[0]} / SoC {sax_value[1]}% / Power {sax_power}W / SmartMeter Power {sax_smpower}W")
-
-            starttime = time.time()
-            adl_value = fetch_modbus(client_adl, REG_ADL_START, 23)
-            totaltime_adl = (time.time() - starttime) * 1000
+            # Batteries and smart meter are queried concurrently
+            *sax_results, (adl_value, totaltime_adl) = await asyncio.gather(
+                *(timed_fetch_modbus(battery.client, REG_SAX_START, 4, "sax_read") for battery in batteries),
+                timed_fetch_plan(client_adl, adl_plan, adl_block, "adl_read"))
+            read_time = time.monotonic()
+            totaltime_sax = max(totaltime for _, totaltime in sax_results)
+            # A unit without readings is left out of the cycle, the others are still controlled
+            available = []
+            for battery, (value, totaltime) in zip(batteries, sax_results):
+                if value is None:
+                    # While the circuit breaker is open it has logged the outage already
+                    logging.log(logging.ERROR if battery.client.available else logging.DEBUG, f"No response could be retrieved by {battery.name}. Unit left out of this cycle.")
+                    available.append(False)
+                    continue
+                battery.update(value)
+                available.append(True)
+                logging.debug("%s response in %.3fms: Mode %d / SoC %d%% / Power %dW / SmartMeter Power %dW", battery.name, totaltime, battery.mode, battery.soc, battery.power, battery.smpower)
+            if not all(available):
+                flags |= TRACE_READ_FAILED
+
+            # Without the grid power nothing can be controlled
             if adl_value is None:
-                logging.error("No response could be retrieved by SAX Battery. Retrying full cycle.")
+                logging.log(logging.ERROR if client_adl.available else logging.DEBUG, "No response could be retrieved by ADL400. Retrying full cycle.")
+                await publish_connection_states()
+                age = time.monotonic() - last_complete_read
+                if not failsafe and age >= args.stale_after:
+                    failsafe = True
+                    if args.stale_policy == STALE_ZERO:
+                        sax_target_value = 0
+                        logging.error(f"❌ No complete readings for {age:.0f}s, battery target power set to 0W.")
+                    else:
+                        logging.error(f"❌ No complete readings for {age:.0f}s, battery target power held at {sax_target_value}W.")
+                    controller.hold(sax_target_value)
+                if failsafe and args.stale_policy == STALE_ZERO:
+                    await asyncio.gather(*(write_modbus(battery.client, 41, [0, int(POWER_FACTOR_TARGET*1000)]) for battery in batteries if battery.client.available))
+                else:
+                    # The held setpoint is written again at the keep-alive interval, so the battery does not drop it
+                    await asyncio.gather(*(write_modbus(battery.client, 41, [target & 0xFFFF, int(POWER_FACTOR_TARGET*1000)], tolerance=args.setpoint_tolerance, stage="setpoint_write")
+                                           for battery, target in held_targets if battery.client.available))
+                trace_cycle(totaltime_sax, totaltime_adl, (time.time() - starttime_a) * 1000, 0, 0, sax_target_value, 0, 0, flags | TRACE_READ_FAILED)
+                # Cycles without complete readings run at most once per second instead of spinning
+                cycle_ticker.postpone(FAILED_CYCLE_PERIOD)
                 continue
-            adl_pf = unsigned_to_signed(adl_value[21], 16) * 0.001
-            adl_power = unsigned_to_signed(adl_value[9], 16)
+            if failsafe:
+                logging.info("✅ Readings complete again, control resumed.")
+                failsafe = False
+            last_complete_read = time.monotonic()
+            sax_power = sum(battery.power for battery, ok in zip(batteries, available) if ok)
+            if any(available):
+                sax_data_event.set()
+
+            adl_pf = SIGNED_REGISTER.unpack_from(adl_value, 2 * 21)[0] * 0.001
+            adl_power = SIGNED_REGISTER.unpack_from(adl_value, 2 * 9)[0]
             adl_data_event.set()
-            logging.debug(f"ADL SmartMeter response in {totaltime_adl:.3f}ms: Total Power {adl_power}W / Power Factor {adl_pf:.3f}")
+            logging.debug("ADL SmartMeter response in %.3fms: Total Power %dW / Power Factor %.3f", totaltime_adl, adl_power, adl_pf)
 
             #Calculate target values
-            sax_target_value = sax_power + adl_power
-            if sax_target_value > limit_discharging:
-                sax_target_value = limit_discharging
-            if sax_target_value < limit_charging * (-1):
-                sax_target_value = limit_charging * (-1)
-            if grid_loading:
-                sax_target_value = prio_charging * (-1)
-            if sax_target_value < 0 and sax_value[1] >= 100:
-                sax_target_value = 0
-            if sax_target_value > 0 and sax_value[1] <= emergency_reserve:
-                sax_target_value = 0
-
-            sax_target_value_modbus = sax_target_value
-            if sax_target_value_modbus < 0:
-                sax_target_value_modbus = sax_target_value & 0xFFFF
+            # Each unit is bounded by the limits and its SoC, a unit without readings by (0, 0) so it gets
+            # no share. The controller works on the sum of all units.
+            if current.grid_loading:
+                bounds = [battery.bounds(-BATTERY_MAX_CHARGING, current.limit_discharging, current.emergency_reserve) if ok else (0, 0) for battery, ok in zip(batteries, available)]
+            else:
+                bounds = [battery.bounds(-current.limit_charging, current.limit_discharging, current.emergency_reserve) if ok else (0, 0) for battery, ok in zip(batteries, available)]
+            lower = sum(unit_lower for unit_lower, _ in bounds)
+            upper = sum(unit_upper for _, unit_upper in bounds)
+            if current.grid_loading:
+                sax_target_value = int(clamp(current.prio_charging * (-1), lower, upper))
+                controller.hold(sax_target_value)
+            else:
+                # Feed-forward of the total AC power of all inverters, paused while one of them has no recent values
+                pv_power = None if pv_poller.stale else pv_poller.values[1]
+                sax_target_value = controller.update(sax_power, adl_power, lower, upper, pv_power)
+            socs = tuple(battery.soc if ok else None for battery, ok in zip(batteries, available))
+            unit_targets = dispatch(sax_target_value, bounds, [0 if soc is None else soc for soc in socs], current.emergency_reserve)
+
+            # The bounds keep the setpoint from following the grid power
+            charge_clamped = sax_target_value <= lower and adl_power < 0
+            discharge_clamped = sax_target_value >= upper and adl_power > 0
+            clamped = charge_clamped or discharge_clamped
+            # Bounds reduced by the SoC (battery full, reserve reached) are normal operation, only the configured limits
+            # of the units in this cycle are traced
+            units = sum(available)
+            if not current.grid_loading and ((charge_clamped and lower == -current.limit_charging * units)
+                                             or (discharge_clamped and upper == current.limit_discharging * units)):
+                flags |= TRACE_CLAMPED
+            if cadence is not None:
+                # The period of the next cycle follows the load volatility
+                cycle_ticker.interval = cadence.update(adl_power, sax_target_value - sax_power, current.grid_loading or clamped)
+
             sax_target_pf = int(POWER_FACTOR_TARGET*1000)
+            held_targets = [(battery, target) for battery, target, ok in zip(batteries, unit_targets, available) if ok]
+            written = await asyncio.gather(*(write_modbus(battery.client, 41, [target & 0xFFFF, sax_target_pf], tolerance=args.setpoint_tolerance, stage="setpoint_write")
+                                             for battery, target in held_targets))
+            if False in written:
+                flags |= TRACE_WRITE_FAILED
+            readings = [soc for soc in socs if soc is not None]
+            calc = {"target_power": unit_targets[0], "sax_time": totaltime_sax, "adl_time": totaltime_adl,
+                    "batteries_power": sax_power, "batteries_target_power": sax_target_value,
+                    "batteries_soc": round(sum(readings) / len(readings), 1) if readings else None, "cycle_interval": cycle_ticker.interval, **connection_states()}
+            for battery, target in zip(batteries, unit_targets):
+                if battery.number > 1:
+                    calc[f"target_power{battery.number}"] = target
+            number += 1
+            bus.publish(CycleSnapshot(
+                number=number, time=read_time, timestamp=time.time(), settings=current,
+                batteries=tuple(battery.value if ok else None for battery, ok in zip(batteries, available)), adl=bytes(adl_value), fresh=adl_plan.fresh,
+                pv=pv_poller.values, pv_stale=pv_poller.stale,
+                grid_power=adl_power, powers=tuple(battery.power if ok else None for battery, ok in zip(batteries, available)), socs=socs, batteries_power=sax_power,
+                target=sax_target_value, unit_targets=tuple(unit_targets), calc=MappingProxyType(calc)))
+            if first_setpoint:
+                first_setpoint = False
+                startup = (time.monotonic() - started) * 1000
+                metrics.set("first_setpoint", startup)
+                logging.info(f"✅ First setpoint {sax_target_value}W written {startup:.0f}ms after start.")
 
-            write_modbus(client_sax, 41, [sax_target_value_modbus, sax_target_pf])
-
-            if not mqtt_lock:
-                fetch_pv_data()
-
-            starttime = time.time()
-            await send_mqtt_message(topic=f"{pm_base_topic}/battery/power", payload=sax_power, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power/active/total", payload=adl_power, retain=True)
-
-            if not mqtt_lock:
-                await send_mqtt_message(topic=f"{pm_base_topic}/pv/power/total", payload=pv_value[1], retain=True)
-                await send_mqtt_message(topic=f"{pm_base_topic}/pv/state", payload=pv_value[2], retain=True)
-                await send_mqtt_message(topic=f"{pm_base_topic}/pv/day_yield", payload=pv_value[3], retain=True)
-                await send_mqtt_message(topic=f"{pm_base_topic}/pv/power/dc_in", payload=pv_value[0], retain=True)
-
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power-factor/total", payload=adl_pf, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/battery/target_power", payload=sax_target_value, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/battery/state", payload=sax_value[0], retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/battery/soc", payload=sax_value[1], retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/battery/smpower", payload=sax_smpower, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/voltage/A", payload=adl_value[0] * 0.1, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/voltage/B", payload=adl_value[1] * 0.1, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/voltage/C", payload=adl_value[2] * 0.1, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/current/A", payload=adl_value[3] * 0.01, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/current/B", payload=adl_value[4] * 0.01, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/current/C", payload=adl_value[5] * 0.01, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power/active/A", payload=unsigned_to_signed(adl_value[6], 16), retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power/active/B", payload=unsigned_to_signed(adl_value[7], 16), retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power/active/C", payload=unsigned_to_signed(adl_value[8], 16), retain=True)
-            #await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power/reactive/A", payload=unsigned_to_signed(adl_value[10], 16), retain=True)
-            #await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power/reactive/B", payload=unsigned_to_signed(adl_value[11], 16), retain=True)
-            #await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power/reactive/C", payload=unsigned_to_signed(adl_value[12], 16), retain=True)
-            #await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power/reactive/total", payload=unsigned_to_signed(adl_value[13], 16), retain=True)
-            #await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power/apparent/A", payload=unsigned_to_signed(adl_value[14], 16), retain=True)
-            #await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power/apparent/B", payload=unsigned_to_signed(adl_value[15], 16), retain=True)
-            #await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power/apparent/C", payload=unsigned_to_signed(adl_value[16], 16), retain=True)
-            #await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power/apparent/total", payload=unsigned_to_signed(adl_value[17], 16), retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power-factor/A", payload=unsigned_to_signed(adl_value[18], 16) * 0.001, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power-factor/B", payload=unsigned_to_signed(adl_value[19], 16) * 0.001, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/power-factor/C", payload=unsigned_to_signed(adl_value[20], 16) * 0.001, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/frequency", payload=adl_value[22] * 0.01, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/battery/request/time/actual", payload=totaltime_sax, retain=True)
-            await send_mqtt_message(topic=f"{pm_base_topic}/smartmeter/request/time/actual", payload=totaltime_adl, retain=True)
-            totaltime_mqtt = (time.time() - starttime) * 1000
-            logging.debug(f"MQTT update in {totaltime_mqtt:.3f}ms done.")
             totaltime = (time.time() - starttime_a) * 1000
-            logging.info(f"Cycle terminated in {totaltime:.3f}ms: SAX-Modbus {totaltime_sax:.3f}ms / ADL-Modbus {totaltime_adl:.3f}ms / MQTT {totaltime_mqtt:.3f}ms / Battery target power {sax_target_value}W")
-            
-            schedule.run_pending()
-
-            await asyncio.sleep(args.timeout)
+            metrics.observe("cycle", totaltime)
+            logging.debug("Cycle terminated in %.3fms: SAX-Modbus %.3fms / ADL-Modbus %.3fms / Battery target power %dW", totaltime, totaltime_sax, totaltime_adl, sax_target_value)
+            trace_cycle(totaltime_sax, totaltime_adl, totaltime, adl_power, sax_power, sax_target_value, lower, upper, flags)
 
     except KeyboardInterrupt:
         logging.info("🛑 Processing terminated")
@@ -761,9 +873,21 @@ async def main(args):
         logging.info("🛑 Processing terminated")
 
     finally:
-        await send_mqtt_message(topic=f"{base_availability_topic}", payload="offline", retain=False, overwrite_lock=True)
-        client_sax.close()
-        client_adl.close()
+        for stage in stages:
+            stage.cancel()
+        await scheduler.shutdown()
+        pv_poller.close()
+        if metrics_server is not None:
+            metrics_server.close()
+        if history is not None:
+            history.close()
+        if energy is not None:
+            energy.save()
+        await save_runtime_state()
+        await send_mqtt_message(topic=f"{base_availability_topic}", payload="offline", retain=False)
+        for battery in batteries:
+            await battery.client.close()
+        await client_adl.close()
         task.cancel()
         try:
             await task
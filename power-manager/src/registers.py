@@ -0,0 +1,77 @@
+import math
+from collections import namedtuple
+
+# Declarative register map: offset and count relative to the base address of the device block,
+# tier selects the cadence of the register in the read plan.
+Register = namedtuple("Register", ["name", "offset", "count", "tier"])
+
+TIER_CONTROL = "control"            # Needed by the control law, read every cycle
+TIER_TELEMETRY = "telemetry"        # Only published, read every Nth cycle
+TIER_REACTIVE = "reactive"          # Reactive and apparent power, optional telemetry
+
+ADL400_BASE = 0x61
+ADL400_REGISTERS = (
+    Register("voltage_a", 0, 1, TIER_TELEMETRY),
+    Register("voltage_b", 1, 1, TIER_TELEMETRY),
+    Register("voltage_c", 2, 1, TIER_TELEMETRY),
+    Register("current_a", 3, 1, TIER_TELEMETRY),
+    Register("current_b", 4, 1, TIER_TELEMETRY),
+    Register("current_c", 5, 1, TIER_TELEMETRY),
+    Register("actpower_a", 6, 1, TIER_TELEMETRY),
+    Register("actpower_b", 7, 1, TIER_TELEMETRY),
+    Register("actpower_c", 8, 1, TIER_TELEMETRY),
+    Register("actpower_total", 9, 1, TIER_CONTROL),
+    Register("reactpower_a", 10, 1, TIER_REACTIVE),
+    Register("reactpower_b", 11, 1, TIER_REACTIVE),
+    Register("reactpower_c", 12, 1, TIER_REACTIVE),
+    Register("reactpower_total", 13, 1, TIER_REACTIVE),
+    Register("apppower_a", 14, 1, TIER_REACTIVE),
+    Register("apppower_b", 15, 1, TIER_REACTIVE),
+    Register("apppower_c", 16, 1, TIER_REACTIVE),
+    Register("apppower_total", 17, 1, TIER_REACTIVE),
+    Register("power_factor_a", 18, 1, TIER_TELEMETRY),
+    Register("power_factor_b", 19, 1, TIER_TELEMETRY),
+    Register("power_factor_c", 20, 1, TIER_TELEMETRY),
+    Register("power_factor_total", 21, 1, TIER_TELEMETRY),
+    Register("frequency", 22, 1, TIER_TELEMETRY),
+)
+
+class ReadPlan:
+    # Precomputed merged read requests per cycle. cadences maps a tier to the number of cycles
+    # between two reads (tiers without cadence are not read). The first cycle reads all registers.
+    # Registers due in a cycle are merged into one request if the gap between them is at most
+    # max_gap registers, one request costs more than reading a few registers more.
+
+    def __init__(self, base, registers, cadences, max_gap=8, max_count=125):
+        self.base = base
+        self.length = max(register.offset + register.count for register in registers)
+        active = [register for register in registers if cadences.get(register.tier)]
+        period = math.lcm(*(cadences[register.tier] for register in active)) if active else 1
+        self.max_gap = max_gap
+        self.max_count = max_count
+        self.plans = [self._merge([register for register in active if cycle % cadences[register.tier] == 0]) for cycle in range(period)]
+        self.offsets = [frozenset(offset for start, count in plan for offset in range(start, start + count)) for plan in self.plans]
+        self.cycle = 0
+        self.fresh = frozenset()          # Offsets read by the requests of the last successful cycle
+
+    def _merge(self, registers):
+        requests = []
+        for register in sorted(registers, key=lambda register: register.offset):
+            end = register.offset + register.count
+            if requests:
+                start, count = requests[-1]
+                if register.offset <= start + count + self.max_gap and end - start <= self.max_count:
+                    requests[-1] = (start, max(count, end - start))
+                    continue
+            requests.append((register.offset, register.count))
+        return requests
+
+    def next(self):
+        # (offset, count) of the requests of the next cycle. The plan only advances by done(), the
+        # requests of a failed cycle are repeated and the full first read until it succeeded once.
+        return self.plans[self.cycle % len(self.plans)]
+
+    def done(self):
+        # All requests of the cycle were read
+        self.fresh = self.offsets[self.cycle % len(self.plans)]
+        self.cycle += 1
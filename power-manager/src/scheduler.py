@@ -0,0 +1,105 @@
+import asyncio
+import logging
+
+OVERRUN_SKIP = "skip"
+OVERRUN_CATCHUP = "catchup"
+
+class JitterStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.overruns = 0
+        self.skipped = 0
+
+    def add(self, jitter):
+        self.count += 1
+        self.total += jitter
+        if jitter > self.max:
+            self.max = jitter
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def summary(self):
+        return f"{self.count} runs / jitter mean {self.mean * 1000:.3f}ms max {self.max * 1000:.3f}ms / {self.overruns} overruns / {self.skipped} skipped"
+
+class Ticker:
+    # Fixed-rate ticker working against absolute deadlines of the event loop clock,
+    # so the period does not drift with the time spent in the cycle itself.
+
+    def __init__(self, interval, overrun_policy=OVERRUN_SKIP, max_catchup=3):
+        self.interval = interval
+        self.overrun_policy = overrun_policy
+        self.max_catchup = max_catchup
+        self.deadline = None
+        self.resume = None
+        self.stats = JitterStats()
+
+    def postpone(self, period):
+        # The next tick is due period seconds from now, at least one interval. The deadlines continue
+        # from there, the delay is no overrun.
+        self.resume = asyncio.get_running_loop().time() + max(period, self.interval)
+
+    async def tick(self):
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+        if self.resume is not None:
+            self.deadline = self.resume
+            self.resume = None
+            if self.deadline > now:
+                await asyncio.sleep(self.deadline - now)
+        elif self.deadline is None or self.interval <= 0:
+            self.deadline = now
+        else:
+            self.deadline += self.interval
+            if now > self.deadline:
+                self.stats.overruns += 1
+                missed = int((now - self.deadline) // self.interval)
+                if self.overrun_policy == OVERRUN_CATCHUP:
+                    # Run the missed cycles back to back, but never more than max_catchup of them
+                    if missed > self.max_catchup:
+                        self.stats.skipped += missed - self.max_catchup
+                        self.deadline += (missed - self.max_catchup) * self.interval
+                else:
+                    self.stats.skipped += missed + 1
+                    self.deadline += (missed + 1) * self.interval
+            if self.deadline > now:
+                await asyncio.sleep(self.deadline - now)
+        self.stats.add(max(0.0, loop.time() - self.deadline))
+
+class Scheduler:
+    def __init__(self):
+        self.jobs = {}
+        self._tasks = set()
+
+    def every(self, interval, job, name=None, overrun_policy=OVERRUN_SKIP, run_immediately=False):
+        name = name or job.__name__
+        ticker = Ticker(interval, overrun_policy)
+        self.jobs[name] = ticker
+        task = asyncio.create_task(self._run(name, ticker, job, run_immediately))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return ticker
+
+    async def _run(self, name, ticker, job, run_immediately):
+        await ticker.tick()
+        if not run_immediately:
+            await ticker.tick()
+        while True:
+            try:
+                await job()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"❌ Scheduled job {name} failed: {e}")
+            await ticker.tick()
+
+    async def shutdown(self):
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
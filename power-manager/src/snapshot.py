@@ -0,0 +1,28 @@
+import json
+import logging
+import time
+
+from storage import write_json
+
+SNAPSHOT_VERSION = 1
+
+def load_snapshot(path):
+    # Runtime state stored by the last run, None if there is none or it cannot be used
+    try:
+        with open(path, "r") as file:
+            snapshot = json.load(file)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError) as e:
+        logging.error(f"❌ Unable to read runtime state from {path}: {e}")
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get("version") != SNAPSHOT_VERSION:
+        logging.info(f"Runtime state in {path} has an unknown format, starting with defaults")
+        return None
+    return snapshot
+
+def save_snapshot(path, state):
+    try:
+        write_json(path, {"version": SNAPSHOT_VERSION, "time": time.time(), **state})
+    except OSError as e:
+        logging.error(f"❌ Unable to store runtime state in {path}: {e}")
@@ -0,0 +1,12 @@
+import json
+import os
+
+def write_json(path, data):
+    # Written to a temporary file which then replaces the file at path, a crash leaves either the
+    # old or the new content but never a truncated file. Raises OSError.
+    temporary = f"{path}.tmp"
+    with open(temporary, "w") as file:
+        json.dump(data, file)
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(temporary, path)
@@ -0,0 +1,91 @@
+import logging
+import struct
+import time
+
+TRACE_OVERRUN = 1                  # Cycle started after its deadline
+TRACE_READ_FAILED = 2              # Readings of a device missing, a battery is left out, without the ADL400 no setpoint is computed
+TRACE_CLAMPED = 4                  # Setpoint limited by the configured charging/discharging limits against the grid power
+TRACE_WRITE_FAILED = 8             # Writing the setpoint of a unit failed
+TRACE_FLAGS = {TRACE_OVERRUN: "overrun", TRACE_READ_FAILED: "read failed", TRACE_CLAMPED: "clamped", TRACE_WRITE_FAILED: "write failed"}
+TRACE_ERRORS = TRACE_READ_FAILED | TRACE_WRITE_FAILED    # Anomalies whose dump is logged as error, the others as warning
+
+# Cycle number, wall clock time, SAX/ADL read and cycle time in ms, grid power, battery power,
+# target power, lower and upper bound in W, anomaly flags
+TRACE_RECORD = struct.Struct("<IdfffiiiiiB")
+
+class TraceRing:
+    # Fixed size binary ring of the traces of the last control cycles. A record is packed into a
+    # preallocated buffer, nothing is formatted or logged until an anomaly asks for a dump.
+    # Dumps are logged at most once per min_interval seconds and anomaly flag, so frequent clamping
+    # does not hide a following read or write failure.
+
+    def __init__(self, capacity=120, min_interval=60.0):
+        self.capacity = capacity
+        self.min_interval = min_interval
+        self.buffer = bytearray(TRACE_RECORD.size * capacity)
+        self.count = 0
+        self.last_dumps = {}              # flag => monotonic time of its last dump
+
+    def record(self, sax_time, adl_time, cycle_time, grid_power, battery_power, target, lower, upper, flags):
+        self.count += 1
+        if self.capacity:
+            TRACE_RECORD.pack_into(self.buffer, (self.count - 1) % self.capacity * TRACE_RECORD.size, self.count, time.time(), sax_time, adl_time,
+                                   cycle_time, grid_power, battery_power, target, lower, upper, flags)
+
+    def records(self):
+        # Unpacked records, oldest first
+        first = max(0, self.count - self.capacity)
+        return [TRACE_RECORD.unpack_from(self.buffer, position % self.capacity * TRACE_RECORD.size) for position in range(first, self.count)]
+
+    def dump(self, reason, flags, now=None):
+        now = time.monotonic() if now is None else now
+        due = [flag for flag in TRACE_FLAGS if flags & flag and (flag not in self.last_dumps or now - self.last_dumps[flag] >= self.min_interval)]
+        if not self.capacity or not due:
+            return False
+        for flag in due:
+            self.last_dumps[flag] = now
+        records = self.records()
+        if flags & TRACE_ERRORS:
+            logging.error("❌ %s, trace of the last %d cycles:", reason, len(records))
+        else:
+            logging.warning("%s, trace of the last %d cycles:", reason, len(records))
+        for number, timestamp, sax_time, adl_time, cycle_time, grid_power, battery_power, target, lower, upper, flags in records:
+            logging.info("Cycle %d at %s.%03d: SAX-Modbus %.3fms / ADL-Modbus %.3fms / Cycle %.3fms / Grid %dW / Battery %dW / Target %dW (%d..%dW)%s",
+                         number, time.strftime("%H:%M:%S", time.localtime(timestamp)), int(timestamp * 1000) % 1000, sax_time, adl_time, cycle_time,
+                         grid_power, battery_power, target, lower, upper, f" / {describe_flags(flags)}" if flags else "")
+        return True
+
+def describe_flags(flags):
+    return ", ".join(name for flag, name in TRACE_FLAGS.items() if flags & flag)
+
+class CycleSummary:
+    # Aggregates the control cycles between two log lines, so at INFO level one line per interval
+    # is written instead of one per cycle
+    def __init__(self, interval):
+        self.interval = interval
+        self.started = time.monotonic()
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.failed = 0
+
+    def add(self, cycle_time, failed=False):
+        self.count += 1
+        self.total += cycle_time
+        if cycle_time > self.max:
+            self.max = cycle_time
+        if failed:
+            self.failed += 1
+
+    def due(self, now):
+        return now - self.started >= self.interval
+
+    def log(self, now, target):
+        if self.count:
+            logging.info("Cycles of the last %.0fs: %d / mean %.3fms max %.3fms / %d without complete readings / Battery target power %dW",
+                         now - self.started, self.count, self.total / self.count, self.max, self.failed, target)
+        self.started = now
+        self.reset()
@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# End-to-end benchmark of the power manager control cycle against the local simulator.
+# Runs pwrmgr.main() with the simulated devices and MQTT broker for a given duration and
+# reports cycle time percentiles and throughput.
+#
+# Usage: python tools/benchmark.py [--duration 30] [--timeout 0] [--latency 0.01] [--batteries 2] [--inverters 2] [-- <additional pwrmgr arguments>]
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import pwrmgr
+from scheduler import Ticker
+from simulator import Simulator
+
+class RecordingTicker(Ticker):
+    # Records the time between the start of a cycle and the next call of tick()
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.durations = []
+        self._started = None
+
+    async def tick(self):
+        if self._started is not None:
+            self.durations.append(time.perf_counter() - self._started)
+        await super().tick()
+        self._started = time.perf_counter()
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+async def sample_grid(plant, samples):
+    # Absolute grid power every 50ms as measure of the control quality
+    while True:
+        samples.append(abs(plant.grid_power))
+        await asyncio.sleep(0.05)
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Power Manager cycle benchmark")
+    parser.add_argument("--duration", type=float, default=30, help="Duration of the benchmark in seconds")
+    parser.add_argument("--warmup", type=float, default=3, help="Seconds at the start which are not measured")
+    parser.add_argument("--timeout", type=float, default=0, help="Control cycle period, 0 runs the cycles back to back")
+    parser.add_argument("--latency", type=float, default=0.0, help="Base latency of each simulated device response in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Maximum random latency added to each simulated response in seconds")
+    parser.add_argument("--fault-rate", type=float, default=0.0, help="Probability of an injected fault per device request")
+    parser.add_argument("--seed", type=int, default=1, help="Seed for the simulator")
+    parser.add_argument("--batteries", type=int, default=1, help="Number of simulated SAX Battery units")
+    parser.add_argument("--inverters", type=int, default=1, help="Number of simulated PV inverters")
+    parser.add_argument("--log", type=str, default="ERROR", help="Logging level of the power manager during the benchmark")
+    parser.add_argument("pwrmgr_args", nargs="*", help="Additional arguments passed to the power manager")
+    return parser.parse_args()
+
+async def run(args):
+    simulator = Simulator(args.latency, args.jitter, args.fault_rate, args.seed, batteries=args.batteries, inverters=args.inverters)
+    await simulator.start()
+    logging.getLogger().setLevel(getattr(logging, args.log.upper()))
+
+    with tempfile.TemporaryDirectory() as config_dir:
+        sys.argv = ["pwrmgr.py", f"--timeout={args.timeout}", f"--config-dir={config_dir}"] + simulator.pwrmgr_arguments() + args.pwrmgr_args
+        pwrmgr_args = pwrmgr.parse_arguments()
+        pwrmgr.Ticker = RecordingTicker
+        task = asyncio.create_task(pwrmgr.main(pwrmgr_args))
+
+        await asyncio.sleep(args.warmup)
+        ticker = pwrmgr.cycle_ticker
+        measured = len(ticker.durations)
+        mqtt_start = simulator.broker.received
+        reads_start = sum(sax.reads for sax in simulator.saxes) + simulator.adl.reads
+        writes_start = sum(sax.writes for sax in simulator.saxes)
+        grid_samples = []
+        sampler = asyncio.create_task(sample_grid(simulator.plant, grid_samples))
+        starttime = time.perf_counter()
+        await asyncio.sleep(args.duration)
+        elapsed = time.perf_counter() - starttime
+        sampler.cancel()
+        durations = ticker.durations[measured:]
+        mqtt_messages = simulator.broker.received - mqtt_start
+        reads = sum(sax.reads for sax in simulator.saxes) + simulator.adl.reads - reads_start
+        writes = sum(sax.writes for sax in simulator.saxes) - writes_start
+
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    await simulator.stop()
+
+    cycles = len(durations)
+    print(f"Cycles:        {cycles} in {elapsed:.1f}s ({cycles / elapsed:.1f} cycles/s)")
+    if cycles:
+        print(f"Cycle time:    p50 {percentile(durations, 0.5) * 1000:.3f}ms / p90 {percentile(durations, 0.9) * 1000:.3f}ms / "
+              f"p99 {percentile(durations, 0.99) * 1000:.3f}ms / max {max(durations) * 1000:.3f}ms")
+        print(f"MQTT:          {mqtt_messages} messages ({mqtt_messages / cycles:.1f} per cycle)")
+        print(f"Modbus:        {reads} reads / {writes} setpoint writes ({writes / cycles:.2f} per cycle)")
+    print(f"Faults:        {simulator.faults.injected} injected")
+    if grid_samples:
+        print(f"Grid error:    mean {sum(grid_samples) / len(grid_samples):.0f}W / p90 {percentile(grid_samples, 0.9):.0f}W")
+    print(f"Plant:         grid {simulator.plant.grid_power:.0f}W / battery {simulator.plant.battery_power:.0f}W (target {simulator.plant.target}W) / SoC {simulator.plant.soc:.1f}%")
+    if len(simulator.plant.batteries) > 1:
+        for unit, battery in enumerate(simulator.plant.batteries, start=1):
+            print(f"Battery {unit}:     {battery.power:.0f}W (target {battery.target}W) / SoC {battery.soc:.1f}%")
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_arguments()))
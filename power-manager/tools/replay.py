@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+# Offline replay of recorded traces against the battery target computation.
+# The net load (grid power + battery power) of a CSV file or of the add-on's history.bin is replayed
+# against one or more strategies (limits, emergency reserve, prio charging, grid loading window) with a
+# NumPy battery model, much faster than real time. Reports grid import/export energy, battery cycling and
+# settling after load steps per strategy next to the recorded operation. Requires NumPy.
+#
+# CSV files have a header with the signal names of the history: time (epoch seconds or ISO 8601),
+# smartmeter_actpower_total, battery_power or batteries_power and optionally battery_soc or batteries_soc.
+#
+# Usage: python tools/replay.py <history.bin|trace.csv> [--strategy limit_charging=2000,emergency_reserve=20]
+#                               [--strategy name=night,grid_loading=1-5,prio_charging=2000] [--capacity 5800]
+import argparse
+import csv
+import datetime
+import hashlib
+import math
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from battery import BATTERY_MAX_CHARGING
+from cycle import Settings
+from entities import STATE_ENTITIES, extra_entities, history_signals
+from history import HEADER, HEADER_SIZE, HISTORY_MAGIC
+
+GRID_SIGNAL = "smartmeter_actpower_total"
+BATTERY_SIGNALS = ("batteries_power", "battery_power")     # Combined power of several units first
+SOC_SIGNALS = ("batteries_soc", "battery_soc")
+MAX_UNITS = 8                     # Battery units tried when matching the layout of a history file
+MAX_GAP = 60.0                    # Seconds, longer gaps between samples (add-on not running) are not accounted
+STEP_THRESHOLD = 200              # W change of the net load between two samples counted as load step
+SETTLED_TOLERANCE = 50            # W grid power counted as settled after a load step
+SETTLING_WINDOW = 60              # Seconds after a load step, later settling is caused by saturation, not control
+DIRECTION_THRESHOLD = 50          # W battery power below which no direction is counted
+MIN_WINDOW = 64                   # Samples of the first pass after a SoC bound was crossed
+MAX_WINDOW = 65536
+
+def load_history(path):
+    # Signal columns of a history.bin in time order, the layout is matched by the schema digest
+    with open(path, "rb") as file:
+        magic, capacity, signals, head, count, schema = HEADER.unpack(file.read(HEADER.size))
+    if magic != HISTORY_MAGIC:
+        raise ValueError(f"{path} is not a history file")
+    for units in range(1, MAX_UNITS + 1):
+        for reactive_power in (False, True):
+            names = history_signals(STATE_ENTITIES + extra_entities(units, reactive_power))
+            if len(names) == signals and hashlib.sha256("\n".join(names).encode()).digest() == schema:
+                break
+        else:
+            continue
+        break
+    else:
+        raise ValueError(f"Signal layout of {path} is unknown")
+
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    order = (head - count + np.arange(count)) % capacity
+    columns = {"time": data[HEADER_SIZE:HEADER_SIZE + capacity * 8].view("<f8")[order]}
+    offset = HEADER_SIZE + capacity * 8
+    for column, name in enumerate(names):
+        if name in (GRID_SIGNAL, *BATTERY_SIGNALS, *SOC_SIGNALS):
+            begin = offset + column * capacity * 4
+            columns[name] = data[begin:begin + capacity * 4].view("<f4")[order].astype(np.float64)
+    return columns, units
+
+def parse_time(value):
+    try:
+        return float(value)
+    except ValueError:
+        return datetime.datetime.fromisoformat(value).timestamp()
+
+def load_csv(path):
+    with open(path, newline="") as file:
+        reader = csv.reader(file)
+        header = [name.strip() for name in next(reader)]
+        rows = list(reader)
+    columns = {}
+    for position, name in enumerate(header):
+        if name == "time":
+            columns[name] = np.array([parse_time(row[position]) for row in rows])
+        elif name in (GRID_SIGNAL, *BATTERY_SIGNALS, *SOC_SIGNALS):
+            columns[name] = np.array([float(row[position]) if row[position].strip() else math.nan for row in rows])
+    return columns
+
+class Trace:
+    # Samples of a recording with complete grid and battery power. dt is the time until the next sample,
+    # net the load the batteries would have to cover to keep the grid power at zero.
+
+    def __init__(self, columns):
+        battery_signal = next((name for name in BATTERY_SIGNALS if name in columns), None)
+        if "time" not in columns or GRID_SIGNAL not in columns or battery_signal is None:
+            raise ValueError(f"Trace needs the signals time, {GRID_SIGNAL} and {' or '.join(BATTERY_SIGNALS)}")
+        valid = np.isfinite(columns["time"]) & np.isfinite(columns[GRID_SIGNAL]) & np.isfinite(columns[battery_signal])
+        order = np.argsort(columns["time"][valid], kind="stable")
+        self.time = columns["time"][valid][order]
+        self.grid = columns[GRID_SIGNAL][valid][order]
+        self.battery = columns[battery_signal][valid][order]
+        soc_signal = next((name for name in SOC_SIGNALS if name in columns), None)
+        self.soc = columns[soc_signal][valid][order] if soc_signal else None
+        self.dt = np.diff(self.time, append=self.time[-1] if len(self.time) else 0.0)
+        self.dt[self.dt > MAX_GAP] = 0.0
+        self.net = self.grid + self.battery
+
+    def __len__(self):
+        return len(self.time)
+
+    def initial_soc(self):
+        if self.soc is not None:
+            known = self.soc[np.isfinite(self.soc)]
+            if known.size:
+                return float(known[0])
+        return 50.0
+
+def parse_window(value):
+    # Grid loading window in local hours "start-end", e.g. 1-5 or 22-6, "off" for none
+    if value == "off":
+        return None
+    start, end = value.split("-")
+    return float(start), float(end)
+
+STRATEGY_KEYS = {
+    "limit_charging": int,
+    "limit_discharging": int,
+    "emergency_reserve": int,
+    "prio_charging": int,
+    "grid_loading": parse_window,
+}
+
+def parse_strategy(spec):
+    # key=value pairs separated by commas, keys not given keep the start values of the power manager
+    strategy = {"name": spec or "default", **Settings()._asdict(), "grid_loading": None}
+    for item in filter(None, spec.split(",")):
+        key, _, value = item.partition("=")
+        if key == "name":
+            strategy["name"] = value
+        elif key in STRATEGY_KEYS:
+            strategy[key] = STRATEGY_KEYS[key](value)
+        else:
+            raise argparse.ArgumentTypeError(f"Unknown strategy parameter {key}, known are name, {', '.join(STRATEGY_KEYS)}")
+    return strategy
+
+def loading_mask(times, window):
+    # Samples within the grid loading window, the UTC offset of the first sample is used for the whole trace
+    if window is None or not len(times):
+        return np.zeros(len(times), dtype=bool)
+    offset = datetime.datetime.fromtimestamp(times[0]).astimezone().utcoffset().total_seconds()
+    hours = (times + offset) % 86400 / 3600
+    start, end = window
+    return (hours >= start) & (hours < end) if start <= end else (hours >= start) | (hours < end)
+
+def simulate(trace, strategy, units, capacity, efficiency, soc):
+    # Battery power and SoC per sample. The target law is that of the power manager with P gain 1:
+    # the net load limited by the charging/discharging limits, or -prio_charging while grid loading.
+    # The battery follows the target within one sample and stops at 100% and at the emergency reserve.
+    # Between two crossings of a SoC bound the target does not depend on the SoC, so the SoC is a
+    # cumulative sum. Each pass integrates a window of samples and ends at the first crossing, the
+    # window grows while no bound is crossed.
+    lower = -units * strategy["limit_charging"]
+    upper = units * strategy["limit_discharging"]
+    reserve = strategy["emergency_reserve"]
+    desired = np.clip(trace.net, lower, upper)
+    loading = loading_mask(trace.time, strategy["grid_loading"])
+    desired[loading] = min(max(-strategy["prio_charging"], -units * BATTERY_MAX_CHARGING), upper)
+    eta = math.sqrt(efficiency)
+    scale = 100 / (units * capacity * 3600)              # % per Ws
+
+    count = len(trace)
+    power = np.empty(count)
+    levels = np.empty(count)                            # SoC at the start of each sample
+    level = soc
+    window = MIN_WINDOW
+    start = 0
+    while start < count:
+        end = min(count, start + window)
+        target = desired[start:end].copy()
+        if level >= 100:
+            np.maximum(target, 0, out=target)           # Battery full, no charging
+        elif level <= reserve:
+            np.minimum(target, 0, out=target)           # Reserve reached, no discharging
+        after = level + np.cumsum(np.where(target > 0, -target / eta, -target * eta) * trace.dt[start:end] * scale)
+        if level >= 100:
+            crossing = after < 100
+        elif level <= reserve:
+            crossing = after > reserve
+        else:
+            crossing = (after >= 100) | (after <= reserve)
+        hits = np.flatnonzero(crossing)
+        last = hits[0] if hits.size else end - start - 1
+        power[start:start + last + 1] = target[:last + 1]
+        levels[start] = level
+        levels[start + 1:start + last + 1] = after[:last]
+        new_level = after[last]
+        if hits.size:
+            before = after[last - 1] if last else level
+            bound = 100.0 if new_level >= 100 else float(reserve) if new_level <= reserve else None
+            if bound is not None and new_level != before:
+                # The battery stops at the bound within the sample, only the power up to it counts
+                power[start + last] *= (bound - before) / (new_level - before)
+                new_level = bound
+            window = MIN_WINDOW
+        else:
+            window = min(window * 2, MAX_WINDOW)
+        level = new_level
+        start += last + 1
+
+    # Targets are computed from the sample and take effect until the next one
+    grid = trace.net - np.concatenate((power[:1], power[:-1]))
+    return grid, power, levels, level
+
+def evaluate(trace, grid, power, units, capacity):
+    dt = trace.dt
+    charged = np.sum(np.maximum(-power, 0) * dt) / 3.6e6
+    discharged = np.sum(np.maximum(power, 0) * dt) / 3.6e6
+    directions = np.sign(power[np.abs(power) > DIRECTION_THRESHOLD])
+    following = np.abs(power - trace.net) < 1
+    steps = np.flatnonzero(np.abs(np.diff(trace.net)) > STEP_THRESHOLD) + 1
+    step_count = max(steps.size, 1)
+    settled = np.flatnonzero(np.abs(grid) <= SETTLED_TOLERANCE)
+    found = np.searchsorted(settled, steps)
+    steps, found = steps[found < settled.size], found[found < settled.size]
+    settling = trace.time[settled[found]] - trace.time[steps]
+    settling = settling[settling <= SETTLING_WINDOW]
+    total = np.sum(dt) or 1.0
+    return {
+        "Grid import kWh": np.sum(np.maximum(grid, 0) * dt) / 3.6e6,
+        "Grid export kWh": np.sum(np.maximum(-grid, 0) * dt) / 3.6e6,
+        "Charged kWh": charged,
+        "Discharged kWh": discharged,
+        "Full cycles": discharged * 1000 / (units * capacity),
+        "Direction changes": np.count_nonzero(np.diff(directions)),
+        "Load not covered %": 100 * np.sum(dt[~following]) / total,
+        "Mean |grid| W": np.sum(np.abs(grid) * dt) / total,
+        "Load steps settled %": 100 * settling.size / step_count,
+        "Settling mean s": float(np.mean(settling)) if settling.size else 0.0,
+    }
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Power Manager offline replay")
+    parser.add_argument("trace", help="history.bin of the add-on or CSV file with the recorded signals")
+    parser.add_argument("--strategy", action="append", type=parse_strategy, default=[],
+                        help="Strategy as key=value list (name, limit_charging, limit_discharging, emergency_reserve, prio_charging, grid_loading=start-end hours), repeatable")
+    parser.add_argument("--batteries", type=int, default=None, help="Number of battery units (default: from the history layout or 1)")
+    parser.add_argument("--capacity", type=float, default=5800, help="Usable capacity per battery unit in Wh (default: 5800)")
+    parser.add_argument("--efficiency", type=float, default=0.9, help="Round trip efficiency of the batteries (default: 0.9)")
+    parser.add_argument("--soc", type=float, default=None, help="SoC at the start in %% (default: first recorded SoC or 50)")
+    return parser.parse_args()
+
+def run(args):
+    starttime = time.perf_counter()
+    units = 1
+    if args.trace.endswith(".csv"):
+        columns = load_csv(args.trace)
+    else:
+        columns, units = load_history(args.trace)
+    units = args.batteries or units
+    trace = Trace(columns)
+    if not len(trace):
+        raise SystemExit(f"{args.trace} has no complete samples")
+    soc = trace.initial_soc() if args.soc is None else args.soc
+    print(f"Trace:         {len(trace)} samples over {(trace.time[-1] - trace.time[0]) / 86400:.2f} days, "
+          f"{np.sum(trace.dt) / 3600:.1f}h accounted, loaded in {time.perf_counter() - starttime:.2f}s")
+
+    results = {"recorded": evaluate(trace, trace.grid, trace.battery, units, capacity=args.capacity)}
+    final = {"recorded": float(trace.soc[np.isfinite(trace.soc)][-1]) if trace.soc is not None and np.isfinite(trace.soc).any() else math.nan}
+    starttime = time.perf_counter()
+    for strategy in args.strategy or [parse_strategy("")]:
+        grid, power, _, level = simulate(trace, strategy, units, args.capacity, args.efficiency, soc)
+        results[strategy["name"]] = evaluate(trace, grid, power, units, args.capacity)
+        final[strategy["name"]] = level
+    elapsed = time.perf_counter() - starttime
+    print(f"Replay:        {len(results) - 1} strategies in {elapsed:.2f}s ({len(trace) * (len(results) - 1) / max(elapsed, 1e-9) / 1e6:.1f}M samples/s)")
+
+    width = max(12, *(len(name) + 2 for name in results))
+    print(f"{'':20}" + "".join(f"{name:>{width}}" for name in results))
+    for metric in results["recorded"]:
+        print(f"{metric:20}" + "".join(f"{result[metric]:>{width}.2f}" for result in results.values()))
+    print(f"{'Final SoC %':20}" + "".join(f"{level:>{width}.1f}" for level in final.values()))
+
+if __name__ == "__main__":
+    run(parse_arguments())
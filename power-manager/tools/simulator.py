@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+# Local simulator of the devices the power manager talks to:
+#  - one or more SAX Batteries via Modbus TCP (unit 64, holding registers 41-48)
+#  - ADL400 SmartMeter via Modbus TCP (unit 158, 23 registers from 0x61)
+#  - Kostal style PV inverter REST endpoint /api/dxs.json
+#  - a minimal MQTT 3.1.1 broker as stand-in for the HA MQTT add-on
+# The devices share a simple plant model (household load, PV, batteries with first-order lag).
+# Latency, jitter and faults can be injected per request.
+#
+# Usage: python tools/simulator.py [--latency 0.02] [--jitter 0.01] [--fault-rate 0.01] [--batteries 2]
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import struct
+import time
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(message)s'
+)
+
+UNIT_ID_SAX = 64
+UNIT_ID_ADL = 158
+REG_ADL_START = 0x61
+SAX_OFFSET = 16384
+
+PV_DXS_ENTRIES = (33556736, 67109120, 16780032, 251658754)
+
+class SimBattery:
+    # One SAX Battery unit following its target power with a first-order lag
+
+    def __init__(self, plant, capacity=5800, soc=50.0, tau=2.0):
+        self.plant = plant
+        self.capacity = capacity            # Wh
+        self.soc = soc                      # %
+        self.tau = tau                      # s
+        self.power = 0.0                    # Positive = discharging
+        self.target = 0
+        self.power_factor = 1000
+        self.limit_discharging = 3500
+        self.limit_charging = 3500
+        self.mode = 2                       # 1 = off, 2 = on
+
+    def step(self, dt, speedup):
+        target = self.target if self.mode == 2 else 0
+        target = min(max(target, -self.limit_charging), self.limit_discharging)
+        if (target < 0 and self.soc >= 100) or (target > 0 and self.soc <= 0):
+            target = 0
+        self.power += (target - self.power) * min(1.0, dt / self.tau)
+        self.soc = min(100.0, max(0.0, self.soc - self.power * dt * speedup / 3600 / self.capacity * 100))
+
+    def registers(self):
+        return {
+            41: self.target & 0xFFFF,
+            42: self.power_factor,
+            43: self.limit_discharging,
+            44: self.limit_charging,
+            45: self.mode,
+            46: int(round(self.soc)),
+            47: int(round(self.power)) + SAX_OFFSET,
+            48: int(round(self.plant.grid_power)) + SAX_OFFSET,
+        }
+
+    def write(self, address, values):
+        for register, value in enumerate(values, start=address):
+            if register == 41:
+                self.target = value - 0x10000 if value >= 0x8000 else value
+            elif register == 42:
+                self.power_factor = value
+            elif register == 43:
+                self.limit_discharging = value
+            elif register == 44:
+                self.limit_charging = value
+            elif register == 45:
+                self.mode = value
+            else:
+                return False
+        return True
+
+class Plant:
+    # Household with PV and one or more batteries, advanced in small steps by a background task
+
+    def __init__(self, batteries=1, soc=50.0, base_load=400, pv_peak=6000, speedup=60.0, seed=None):
+        self.random = random.Random(seed)
+        self.base_load = base_load
+        self.pv_peak = pv_peak
+        self.speedup = speedup              # Simulated seconds of the day per real second (PV curve, SoC)
+        self.load = base_load
+        self.spike = 0
+        self.spike_until = 0
+        self.pv_ac = 0.0
+        self.pv_yield = 0.0
+        # Units start with different SoC to exercise the dispatch
+        self.batteries = [SimBattery(self, soc=max(5.0, soc - 15 * unit)) for unit in range(batteries)]
+        self.day_time = 12 * 3600.0
+        self.last_step = time.monotonic()
+
+    @property
+    def battery_power(self):
+        return sum(battery.power for battery in self.batteries)
+
+    @property
+    def target(self):
+        return sum(battery.target for battery in self.batteries)
+
+    @property
+    def soc(self):
+        return sum(battery.soc for battery in self.batteries) / len(self.batteries)
+
+    @property
+    def grid_power(self):
+        return self.load + self.spike - self.pv_ac - self.battery_power
+
+    def step(self):
+        now = time.monotonic()
+        dt = now - self.last_step
+        self.last_step = now
+        self.day_time = (self.day_time + dt * self.speedup) % 86400
+
+        self.load = max(100.0, self.load + self.random.gauss(0, 15) + (self.base_load - self.load) * 0.01)
+        if now > self.spike_until:
+            self.spike = 0
+            if self.random.random() < 0.01:
+                # Kettle, hob, ...
+                self.spike = self.random.choice((1200, 2000, 3000))
+                self.spike_until = now + self.random.uniform(5, 30)
+
+        sun = math.sin(math.pi * (self.day_time - 6 * 3600) / (12 * 3600))
+        self.pv_ac = max(0.0, self.pv_peak * sun * self.random.uniform(0.9, 1.0))
+        self.pv_yield += self.pv_ac * dt * self.speedup / 3600
+
+        for battery in self.batteries:
+            battery.step(dt, self.speedup)
+
+    def adl_registers(self):
+        grid = self.grid_power
+        phases = [grid * share for share in (0.4, 0.35, 0.25)]
+        voltages = [self.random.gauss(230, 1) for _ in range(3)]
+        block = [int(round(v * 10)) for v in voltages]
+        block += [int(round(abs(p) / v * 100)) for p, v in zip(phases, voltages)]
+        block += [int(round(p)) & 0xFFFF for p in phases]
+        block += [int(round(grid)) & 0xFFFF]
+        block += [0] * 8                                        # Reactive and apparent power
+        block += [(990 if p >= 0 else -990) & 0xFFFF for p in phases]
+        block += [(990 if grid >= 0 else -990) & 0xFFFF]
+        block += [int(round(self.random.gauss(50, 0.02) * 100))]
+        return {REG_ADL_START + i: value for i, value in enumerate(block)}
+
+    def pv_entries(self):
+        return [self.pv_ac * 1.04, self.pv_ac, 6 if self.pv_ac > 0 else 0, self.pv_yield]
+
+class Faults:
+    def __init__(self, latency=0.0, jitter=0.0, fault_rate=0.0, seed=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.fault_rate = fault_rate
+        self.random = random.Random(seed)
+        self.injected = 0
+
+    async def delay(self):
+        delay = self.latency + self.random.uniform(0, self.jitter)
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+    def fault(self):
+        if self.fault_rate > 0 and self.random.random() < self.fault_rate:
+            self.injected += 1
+            return self.random.choice(("drop", "exception"))
+        return None
+
+class ModbusDevice:
+    def __init__(self, name, unit_id, read, write, faults):
+        self.name = name
+        self.unit_id = unit_id
+        self.read = read
+        self.write = write
+        self.faults = faults
+        self.offline = False                # Simulated outage, connections are dropped
+        self.reads = 0
+        self.writes = 0
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                if self.offline:
+                    break
+                transaction_id, _, length, unit_id = struct.unpack(">HHHB", header)
+                pdu = await reader.readexactly(length - 1)
+                await self.faults.delay()
+                fault = self.faults.fault()
+                if fault == "drop":
+                    break
+                response = self.respond(pdu, unit_id, fault == "exception")
+                writer.write(struct.pack(">HHHB", transaction_id, 0, len(response) + 1, unit_id) + response)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    def respond(self, pdu, unit_id, exception):
+        function = pdu[0]
+        if exception or unit_id != self.unit_id:
+            return bytes([function | 0x80, 4 if exception else 11])
+        if function == 0x03:
+            address, count = struct.unpack(">HH", pdu[1:5])
+            registers = self.read()
+            if any(register not in registers for register in range(address, address + count)):
+                return bytes([function | 0x80, 2])
+            self.reads += 1
+            return struct.pack(f">BB{count}H", function, 2 * count, *(registers[register] for register in range(address, address + count)))
+        if function == 0x10:
+            address, count, _ = struct.unpack(">HHB", pdu[1:6])
+            values = struct.unpack(f">{count}H", pdu[6:6 + 2 * count])
+            if not self.write(address, values):
+                return bytes([function | 0x80, 2])
+            self.writes += 1
+            return pdu[:5]
+        return bytes([function | 0x80, 1])
+
+class PvServer:
+    # One inverter producing the given share of the plant PV power
+    def __init__(self, plant, faults, share=1.0):
+        self.plant = plant
+        self.faults = faults
+        self.share = share
+        self.offline = False                # Simulated outage, requests are not answered
+        self.requests = 0
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readuntil(b"\r\n\r\n")
+                await self.faults.delay()
+                if self.offline or self.faults.fault() is not None:
+                    break
+                self.requests += 1
+                if b"/api/dxs.json" in request.split(b"\r\n", 1)[0]:
+                    entries = self.plant.pv_entries()
+                    entries = [entries[0] * self.share, entries[1] * self.share, entries[2], entries[3] * self.share]
+                    body = json.dumps({"dxsEntries": [{"dxsId": dxs_id, "value": value} for dxs_id, value in zip(PV_DXS_ENTRIES, entries)]}).encode()
+                    status = b"200 OK"
+                else:
+                    body = b"{}"
+                    status = b"404 Not Found"
+                writer.write(b"HTTP/1.1 " + status + b"\r\nContent-Type: application/json\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+def topic_matches(subscription, topic):
+    sub_levels = subscription.split("/")
+    topic_levels = topic.split("/")
+    for i, level in enumerate(sub_levels):
+        if level == "#":
+            return True
+        if i >= len(topic_levels) or (level != "+" and level != topic_levels[i]):
+            return False
+    return len(sub_levels) == len(topic_levels)
+
+class MqttBroker:
+    # Minimal MQTT 3.1.1 broker: QoS 0/1 publish, subscribe, retained messages, ping
+
+    def __init__(self):
+        self.sessions = {}                  # writer => list of subscriptions
+        self.retained = {}
+        self.received = 0
+        self.offline = False                # Refuses connections while set, see drop()
+
+    @staticmethod
+    async def read_packet(reader):
+        first = (await reader.readexactly(1))[0]
+        length = 0
+        multiplier = 1
+        while True:
+            byte = (await reader.readexactly(1))[0]
+            length += (byte & 0x7F) * multiplier
+            multiplier *= 128
+            if not byte & 0x80:
+                break
+        return first, await reader.readexactly(length)
+
+    @staticmethod
+    def packet(first, body):
+        length = len(body)
+        encoded = bytearray()
+        while True:
+            byte = length % 128
+            length //= 128
+            encoded.append(byte | 0x80 if length else byte)
+            if not length:
+                break
+        return bytes([first]) + bytes(encoded) + body
+
+    def publish_packet(self, topic, payload, retain=False):
+        encoded = topic.encode()
+        return self.packet(0x30 | (1 if retain else 0), struct.pack(">H", len(encoded)) + encoded + payload)
+
+    async def handle(self, reader, writer):
+        self.sessions[writer] = []
+        try:
+            while True:
+                first, body = await self.read_packet(reader)
+                packet_type = first >> 4
+                if packet_type == 1:                            # CONNECT
+                    if self.offline:
+                        writer.write(self.packet(0x20, b"\x00\x03"))  # Server unavailable
+                        await writer.drain()
+                        break
+                    writer.write(self.packet(0x20, b"\x00\x00"))
+                elif packet_type == 3:                          # PUBLISH
+                    qos = (first >> 1) & 0x03
+                    topic_length = struct.unpack(">H", body[:2])[0]
+                    topic = body[2:2 + topic_length].decode()
+                    offset = 2 + topic_length
+                    if qos:
+                        packet_id = body[offset:offset + 2]
+                        offset += 2
+                        writer.write(self.packet(0x40, packet_id))
+                    payload = body[offset:]
+                    self.received += 1
+                    if first & 0x01:
+                        self.retained[topic] = payload
+                    for session, subscriptions in list(self.sessions.items()):
+                        if any(topic_matches(subscription, topic) for subscription in subscriptions):
+                            session.write(self.publish_packet(topic, payload))
+                elif packet_type == 8:                          # SUBSCRIBE
+                    packet_id = body[:2]
+                    offset = 2
+                    granted = bytearray()
+                    while offset < len(body):
+                        topic_length = struct.unpack(">H", body[offset:offset + 2])[0]
+                        subscription = body[offset + 2:offset + 2 + topic_length].decode()
+                        offset += 3 + topic_length
+                        self.sessions[writer].append(subscription)
+                        granted.append(0)
+                    writer.write(self.packet(0x90, packet_id + bytes(granted)))
+                    for topic, payload in self.retained.items():
+                        if any(topic_matches(subscription, topic) for subscription in self.sessions[writer]):
+                            writer.write(self.publish_packet(topic, payload, retain=True))
+                elif packet_type == 12:                         # PINGREQ
+                    writer.write(self.packet(0xD0, b""))
+                elif packet_type == 14:                         # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.sessions.pop(writer, None)
+            writer.close()
+
+    def drop(self, offline=True):
+        # Closes all client connections, new connections are refused while offline is set
+        self.offline = offline
+        for writer in list(self.sessions):
+            writer.close()
+
+class Simulator:
+    def __init__(self, latency=0.0, jitter=0.0, fault_rate=0.0, seed=None, host="127.0.0.1", batteries=1, inverters=1):
+        self.host = host
+        self.plant = Plant(batteries, seed=seed)
+        self.faults = Faults(latency, jitter, fault_rate, seed)
+        self.saxes = [ModbusDevice(f"SAX {unit + 1}", UNIT_ID_SAX, battery.registers, battery.write, self.faults) for unit, battery in enumerate(self.plant.batteries)]
+        self.adl = ModbusDevice("ADL400", UNIT_ID_ADL, self.plant.adl_registers, lambda address, values: False, self.faults)
+        self.pvs = [PvServer(self.plant, self.faults, 1.0 / inverters) for _ in range(inverters)]
+        self.broker = MqttBroker()
+        self.ports = {}
+        self._servers = []
+        self._connections = set()
+        self._task = None
+
+    def _track(self, handler):
+        async def tracked(reader, writer):
+            task = asyncio.current_task()
+            self._connections.add(task)
+            try:
+                await handler(reader, writer)
+            except asyncio.CancelledError:
+                # Stopped by the simulator, end the connection quietly
+                writer.close()
+            finally:
+                self._connections.discard(task)
+        return tracked
+
+    async def start(self, ports=None):
+        ports = ports or {}
+        devices = [("sax" if unit == 0 else f"sax{unit + 1}", sax.handle) for unit, sax in enumerate(self.saxes)]
+        devices += [("pv" if unit == 0 else f"pv{unit + 1}", pv.handle) for unit, pv in enumerate(self.pvs)]
+        for name, handler in devices + [("adl", self.adl.handle), ("mqtt", self.broker.handle)]:
+            server = await asyncio.start_server(self._track(handler), self.host, ports.get(name, 0))
+            self.ports[name] = server.sockets[0].getsockname()[1]
+            self._servers.append(server)
+        self._task = asyncio.create_task(self._run_plant())
+        return self.ports
+
+    async def _run_plant(self):
+        while True:
+            self.plant.step()
+            await asyncio.sleep(0.05)
+
+    async def stop(self):
+        self._task.cancel()
+        for server in self._servers:
+            server.close()
+        connections = list(self._connections)
+        for task in connections:
+            task.cancel()
+        await asyncio.gather(self._task, *connections, return_exceptions=True)
+
+    def pwrmgr_arguments(self):
+        return [
+            f"--host-sax={self.host}", f"--port-sax={self.ports['sax']}",
+            *(f"--battery={self.host}:{self.ports[f'sax{unit}']}" for unit in range(2, len(self.saxes) + 1)),
+            f"--host-adl={self.host}", f"--port-adl={self.ports['adl']}",
+            f"--host-mqtt={self.host}", f"--port-mqtt={self.ports['mqtt']}", "--user-mqtt=sim", "--pw-mqtt=sim",
+            f"--url-pv=http://{self.host}:{self.ports['pv']}", "--user-pv=sim", "--pw-pv=sim",
+            *(argument for unit in range(2, len(self.pvs) + 1) for argument in ("--inverter", f"http://{self.host}:{self.ports[f'pv{unit}']}")),
+        ]
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(description="Power Manager device simulator")
+    parser.add_argument("--latency", type=float, default=0.0, help="Base latency of each device response in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Maximum random latency added to each response in seconds")
+    parser.add_argument("--fault-rate", type=float, default=0.0, help="Probability of a dropped connection or exception response per request")
+    parser.add_argument("--seed", type=int, default=None, help="Seed for the random generators")
+    parser.add_argument("--batteries", type=int, default=1, help="Number of simulated SAX Battery units, further units listen on the following ports")
+    parser.add_argument("--inverters", type=int, default=1, help="Number of simulated PV inverters sharing the PV power, further inverters listen on the following ports")
+    parser.add_argument("--port-sax", type=int, default=5020)
+    parser.add_argument("--port-adl", type=int, default=5021)
+    parser.add_argument("--port-pv", type=int, default=8080)
+    parser.add_argument("--port-mqtt", type=int, default=1883)
+    return parser.parse_args()
+
+async def main(args):
+    simulator = Simulator(args.latency, args.jitter, args.fault_rate, args.seed, batteries=args.batteries, inverters=args.inverters)
+    ports = {"sax": args.port_sax, "adl": args.port_adl, "pv": args.port_pv, "mqtt": args.port_mqtt}
+    ports.update({f"sax{unit}": args.port_sax + 10 + unit for unit in range(2, args.batteries + 1)})
+    ports.update({f"pv{unit}": args.port_pv + 10 + unit for unit in range(2, args.inverters + 1)})
+    await simulator.start(ports)
+    logging.info(f"Simulator running, start the power manager with: {' '.join(simulator.pwrmgr_arguments())}")
+    try:
+        while True:
+            await asyncio.sleep(10)
+            plant = simulator.plant
+            logging.info(f"Grid {plant.grid_power:.0f}W / Battery {plant.battery_power:.0f}W (target {plant.target}W) / SoC {plant.soc:.1f}% / PV {plant.pv_ac:.0f}W")
+    finally:
+        await simulator.stop()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main(parse_arguments()))
+    except KeyboardInterrupt:
+        pass